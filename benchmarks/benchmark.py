@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+################################################################################
+# Copyright (c) 2017, 2018 Genome Research Ltd.
+#
+# Author: Joshua C. Randall <jcrandall@alum.mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Benchmarks each phase of the yatadis pipeline against a synthetic Terraform
+# state, and writes the timings as JSON so that they can be compared across
+# releases (and across jinja2/jinjath versions and template changes).
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import jinja2
+
+from yatadis import yatadis
+
+###############################################################################
+# IP address attributes set on each synthetic instance, by provider, following
+# the attributes used by the default host vars template
+###############################################################################
+PROVIDER_IP_ATTRIBUTES = {
+    "aws_instance": ("public_ip", "private_ip"),
+    "digitalocean_droplet": ("ipv4_address", "ipv4_address_private"),
+    "google_compute_instance": ("network_interface.0.access_config.0.assigned_nat_ip", "network_interface.0.address"),
+    "openstack_compute_instance_v2": ("access_ip_v4", "network.0.fixed_ip_v4"),
+    "triton_machine": ("primaryip",),
+    "vsphere_virtual_machine": ("network_interface.0.ipv4_address",),
+}
+
+# resource types which the default resource filter template excludes
+NON_INSTANCE_TYPES = ("aws_security_group", "openstack_networking_port_v2")
+
+def generate_nested_attributes(attributes, rng, prefix, depth, budget):
+    # adds `budget` leaf attributes under `prefix`, nested as lists of maps
+    # `depth` levels deep
+    if depth <= 1 or budget < 4:
+        for i in range(budget):
+            attributes["%s.field%d" % (prefix, i)] = rng.choice(["true", "false", "value-%d" % (rng.randrange(1000))])
+        return
+    count = max(2, min(8, budget // 4))
+    attributes["%s.#" % (prefix)] = str(count)
+    for i in range(count):
+        share = budget // count + (1 if i < budget % count else 0)
+        generate_nested_attributes(attributes, rng, "%s.%d" % (prefix, i), depth - 1, share)
+
+def generate_resource(rng, index, resource_type, attribute_count, depth):
+    attributes = {
+        "id": "%08x-%04d" % (rng.getrandbits(32), index),
+        "name": "%s-%d" % (resource_type, index),
+    }
+    for attr in PROVIDER_IP_ATTRIBUTES.get(resource_type, ()):
+        attributes[attr] = "10.%d.%d.%d" % (index // 65536 % 256, index // 256 % 256, index % 256)
+    remaining = max(0, attribute_count - len(attributes))
+    scalars = remaining // 3
+    metadata = remaining // 3
+    nested = remaining - scalars - metadata
+    for i in range(scalars):
+        attributes["attr%d" % (i)] = "value-%d" % (rng.randrange(100000))
+    attributes["metadata.%"] = str(metadata)
+    for i in range(metadata):
+        attributes["metadata.key%d" % (i)] = "value-%d" % (rng.randrange(100000))
+    if nested:
+        generate_nested_attributes(attributes, rng, "block_device", depth, nested)
+    return {
+        "type": resource_type,
+        "depends_on": [],
+        "primary": {
+            "id": attributes["id"],
+            "attributes": attributes,
+            "meta": {},
+            "tainted": False,
+        },
+        "deposed": [],
+        "provider": "provider.%s" % (resource_type.split('_')[0]),
+    }
+
+def generate_tfstate(modules, resources_per_module, attribute_count, depth, non_instance_fraction=0.2, seed=0):
+    rng = random.Random(seed)
+    instance_types = sorted(PROVIDER_IP_ATTRIBUTES.keys())
+    tf_state = {"version": 3, "terraform_version": "0.11.7", "serial": 1, "lineage": "benchmark", "modules": []}
+    index = 0
+    for m in range(modules):
+        resources = {}
+        for r in range(resources_per_module):
+            if rng.random() < non_instance_fraction:
+                resource_type = rng.choice(NON_INSTANCE_TYPES)
+            else:
+                resource_type = instance_types[index % len(instance_types)]
+            resources["%s.r%d" % (resource_type, index)] = generate_resource(rng, index, resource_type, attribute_count, depth)
+            index += 1
+        path = ["root"] if m == 0 else ["root", "module%d" % (m)]
+        tf_state["modules"].append({"path": path, "outputs": {"out%d" % (m): {"sensitive": False, "type": "string", "value": "v%d" % (m)}}, "resources": resources, "depends_on": []})
+    return tf_state
+
+###############################################################################
+# Phases
+###############################################################################
+def time_phase(results, name, repeat, func):
+    wall = []
+    cpu = []
+    value = None
+    for _ in range(repeat):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        value = func()
+        cpu.append(time.process_time() - cpu_start)
+        wall.append(time.perf_counter() - wall_start)
+    results[name] = {
+        "wall_min": min(wall),
+        "wall_mean": sum(wall) / len(wall),
+        "cpu_min": min(cpu),
+        "repeat": repeat,
+    }
+    print("%-32s %10.4fs" % (name, min(wall)), file=sys.stderr)
+    return value
+
+def make_args(force_jinja, combined=False, host_vars_format='text'):
+    # start from the parser's defaults (as InventoryBuilder does) so that
+    # options added to yatadis are always present, then pin the options
+    # which would otherwise come from the environment
+    args = yatadis.make_argument_parser().parse_args([])
+    for (option, value) in (('debug', False), ('workers', 1), ('incremental', False), ('force_jinja', force_jinja), ('combined', combined), ('ansible_combined_template', None), ('ansible_output_combined_template', None), ('host_vars_format', host_vars_format), ('output_host_vars_format', 'text'), ('compact', False), ('exclude_host_vars', None), ('no_cache', True)):
+        setattr(args, option, value)
+    sources = {
+        'ansible_resource_filter_template': yatadis.DEFAULT_ANSIBLE_RESOURCE_FILTER_TEMPLATE,
+        'ansible_inventory_name_template': yatadis.DEFAULT_ANSIBLE_INVENTORY_NAME_TEMPLATE,
+        'ansible_groups_template': yatadis.DEFAULT_ANSIBLE_GROUPS_TEMPLATE,
+        'ansible_host_vars_template': yatadis.DEFAULT_ANSIBLE_HOST_VARS_TEMPLATE,
+        'ansible_output_filter_template': yatadis.DEFAULT_ANSIBLE_OUTPUT_FILTER_TEMPLATE,
+        'ansible_output_inventory_name_template': yatadis.DEFAULT_ANSIBLE_OUTPUT_INVENTORY_NAME_TEMPLATE,
+        'ansible_output_groups_template': yatadis.DEFAULT_ANSIBLE_OUTPUT_GROUPS_TEMPLATE,
+        'ansible_output_host_vars_template': yatadis.DEFAULT_ANSIBLE_OUTPUT_HOST_VARS_TEMPLATE,
+    }
+    for (template_arg, source) in sources.items():
+        setattr(args, template_arg, yatadis.LazyTemplate(source))
+    yatadis.prepare_templates(args)
+    return args
+
+def benchmark(state_path, repeat):
+    results = {}
+
+    def load():
+        with open(state_path, 'r') as f:
+            return json.load(f)
+    tf_state = time_phase(results, "json_load", repeat, load)
+
+    def stream():
+        with open(state_path, 'r') as f:
+            return list(yatadis.stream_tfstate_items(f))
+    time_phase(results, "stream_read", repeat, stream)
+
+    items = [item for item in yatadis.iter_tfstate_items(tf_state) if item[0] == "resource"]
+
+    def construct():
+        return [yatadis.Resource(name, item_dict) for (_, name, item_dict) in items]
+    time_phase(results, "resource_construct", repeat, construct)
+
+    def expand():
+        resources = [yatadis.Resource(name, item_dict) for (_, name, item_dict) in items]
+        for resource in resources:
+            dict(resource['primary']['expanded_attributes'].items())
+        return resources
+    resources = time_phase(results, "flatmap_expand", repeat, expand)
+
+    for (mode, force_jinja) in (("jinja", True), ("native", False)):
+        args = make_args(force_jinja)
+        for (phase, template_arg) in (("filter", 'ansible_resource_filter_template'), ("inventory_name", 'ansible_inventory_name_template'), ("groups", 'ansible_groups_template')):
+            template = getattr(args, template_arg)
+            time_phase(results, "render_%s_%s" % (phase, mode), repeat, lambda: [template.render(resource) for resource in resources])
+        host_vars_template = args.ansible_host_vars_template
+        if force_jinja:
+            rendered = time_phase(results, "render_host_vars_jinja", repeat, lambda: [host_vars_template.render(resource) for resource in resources])
+            time_phase(results, "parse_host_vars_jinja", repeat, lambda: [yatadis.parse_host_var_key_values(re.split(r'\s*\n\s*', text), host_vars_template) for text in rendered])
+        else:
+            time_phase(results, "render_host_vars_native", repeat, lambda: [host_vars_template.render_host_vars(resource) for resource in resources])
+
+    for (mode, force_jinja) in (("json_jinja", True), ("json_native", False)):
+        host_vars_template = make_args(force_jinja, host_vars_format='json').ansible_host_vars_template
+        if force_jinja:
+            rendered = time_phase(results, "render_host_vars_%s" % (mode), repeat, lambda: [host_vars_template.render(resource) for resource in resources])
+            time_phase(results, "parse_host_vars_%s" % (mode), repeat, lambda: [yatadis.parse_host_vars_text(text, host_vars_template) for text in rendered])
+        else:
+            time_phase(results, "render_host_vars_%s" % (mode), repeat, lambda: [host_vars_template.render_host_vars(resource) for resource in resources])
+
+    args = make_args(False)
+    item_results = [yatadis.process_tfstate_item(args, *item) for item in yatadis.iter_tfstate_items(tf_state)]
+
+    def merge():
+        groups = {}
+        hosts = {}
+        for (item_groups, item_hosts) in item_results:
+            yatadis.merge_groups_into(groups, item_groups)
+            yatadis.merge_hosts_into(hosts, item_hosts)
+        return {'groups': groups, 'hosts': hosts}
+    tf_state_data = time_phase(results, "merge", repeat, merge)
+
+    time_phase(results, "serialize", repeat, lambda: json.dumps(yatadis.list_groups({'groups': dict(tf_state_data['groups']), 'hosts': tf_state_data['hosts']})))
+    time_phase(results, "serialize_stream", repeat, lambda: yatadis.write_list_json(io.StringIO(), tf_state_data))
+    args.compact = True
+    args.exclude_host_vars = None
+    time_phase(results, "serialize_compact", repeat, lambda: yatadis.write_list_json(io.StringIO(), yatadis.get_output_list_data(args, tf_state_data)))
+
+    for (mode, force_jinja, combined) in (("jinja", True, False), ("combined_jinja", True, True), ("native", False, False)):
+        args = make_args(force_jinja, combined)
+        def end_to_end():
+            with open(state_path, 'r') as f:
+                return yatadis.process_tfstate_stream(args, f)
+        time_phase(results, "end_to_end_%s" % (mode), repeat, end_to_end)
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark yatadis against a synthetic Terraform state')
+    parser.add_argument('--modules', help='Number of modules in the synthetic state', type=int, default=4)
+    parser.add_argument('--resources-per-module', help='Number of resources in each module', type=int, default=250)
+    parser.add_argument('--attributes', help='Number of flatmap attributes in each resource', type=int, default=60)
+    parser.add_argument('--depth', help='Nesting depth of list/map attributes', type=int, default=3)
+    parser.add_argument('--seed', help='Random seed for the synthetic state', type=int, default=0)
+    parser.add_argument('--repeat', help='Number of times each phase is timed (the minimum is reported)', type=int, default=3)
+    parser.add_argument('--state', help='Benchmark an existing .tfstate file rather than generating one', default=None)
+    parser.add_argument('--save-state', help='Write the synthetic state to this path', default=None)
+    parser.add_argument('--output', help='Write the JSON results to this file rather than stdout', type=argparse.FileType('w'), default=sys.stdout)
+    args = parser.parse_args()
+
+    parameters = {"repeat": args.repeat}
+    if args.state is not None:
+        state_path = args.state
+        parameters["state"] = os.path.abspath(state_path)
+    else:
+        parameters.update({"modules": args.modules, "resources_per_module": args.resources_per_module, "attributes": args.attributes, "depth": args.depth, "seed": args.seed})
+        tf_state = generate_tfstate(args.modules, args.resources_per_module, args.attributes, args.depth, seed=args.seed)
+        if args.save_state is not None:
+            state_path = args.save_state
+        else:
+            (fd, state_path) = tempfile.mkstemp(prefix='yatadis-benchmark-', suffix='.tfstate')
+            os.close(fd)
+        with open(state_path, 'w') as f:
+            json.dump(tf_state, f)
+        del tf_state
+    parameters["state_bytes"] = os.path.getsize(state_path)
+
+    try:
+        phases = benchmark(state_path, args.repeat)
+    finally:
+        if args.state is None and args.save_state is None:
+            os.remove(state_path)
+
+    report = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "jinja2": getattr(jinja2, '__version__', None),
+        "timestamp": time.time(),
+        "parameters": parameters,
+        "phases": phases,
+    }
+    json.dump(report, args.output, indent=2, sort_keys=True)
+    args.output.write("\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+################################################################################
+# Copyright (c) 2017, 2018 Genome Research Ltd.
+#
+# Author: Joshua C. Randall <jcrandall@alum.mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# An ansible inventory plugin which builds the inventory in-process using the
+# yatadis InventoryBuilder, rather than running yatadis.py as an inventory
+# script. Any option which is not set in the inventory source falls back to
+# the same TF_STATE / TF_ANSIBLE_* environment variable as the script.
+
+DOCUMENTATION = '''
+    name: yatadis_inventory
+    plugin_type: inventory
+    short_description: Terraform state inventory source (yatadis)
+    description:
+        - Builds an inventory from one or more Terraform state files, using Jinja2 templates to map Terraform
+          resources (and outputs) onto ansible inventory names, groups and host_vars.
+        - Uses a YAML configuration file whose name ends with C(yatadis.yml) or C(yatadis.yaml).
+        - Options which are not set fall back to the environment variables used by the yatadis.py script.
+    requirements:
+        - yatadis (and its dependencies jinja2 and jinjath)
+    extends_documentation_fragment:
+        - inventory_cache
+    options:
+        plugin:
+            description: token that ensures this is a source file for the C(yatadis_inventory) plugin.
+            required: True
+            choices: ['yatadis_inventory']
+        state:
+            description:
+                - Terraform state files, globs or directories (which are searched for C(*.tfstate) files).
+                - Relative paths are relative to the directory of the inventory source.
+                - Defaults to TF_STATE or C(terraform.tfstate).
+            type: list
+        inventory_name_template:
+            description: Template for the inventory name of a resource (TF_ANSIBLE_INVENTORY_NAME_TEMPLATE).
+            type: str
+        groups_template:
+            description: Template for the newline separated groups of a resource (TF_ANSIBLE_GROUPS_TEMPLATE).
+            type: str
+        resource_filter_template:
+            description: Template which renders C(True) for resources to include (TF_ANSIBLE_RESOURCE_FILTER_TEMPLATE).
+            type: str
+        host_vars_template:
+            description: Template for the host_vars of a resource (TF_ANSIBLE_HOST_VARS_TEMPLATE).
+            type: str
+        host_vars_format:
+            description: Format of the host_vars template, C(text) or C(json) (TF_ANSIBLE_HOST_VARS_FORMAT).
+            type: str
+            choices: ['text', 'json']
+        output_inventory_name_template:
+            description: Template for the inventory name of an output (TF_ANSIBLE_OUTPUT_INVENTORY_NAME_TEMPLATE).
+            type: str
+        output_groups_template:
+            description: Template for the newline separated groups of an output (TF_ANSIBLE_OUTPUT_GROUPS_TEMPLATE).
+            type: str
+        output_filter_template:
+            description: Template which renders C(True) for outputs to include (TF_ANSIBLE_OUTPUT_FILTER_TEMPLATE).
+            type: str
+        output_host_vars_template:
+            description: Template for the host_vars of an output (TF_ANSIBLE_OUTPUT_HOST_VARS_TEMPLATE).
+            type: str
+        output_host_vars_format:
+            description: Format of the output host_vars template, C(text) or C(json) (TF_ANSIBLE_OUTPUT_HOST_VARS_FORMAT).
+            type: str
+            choices: ['text', 'json']
+        combined_template:
+            description: Combined template used instead of the separate resource templates (TF_ANSIBLE_COMBINED_TEMPLATE).
+            type: str
+        output_combined_template:
+            description: Combined template used instead of the separate output templates (TF_ANSIBLE_OUTPUT_COMBINED_TEMPLATE).
+            type: str
+        combined:
+            description: Render the templates of each resource in a single pass (TF_ANSIBLE_COMBINED).
+            type: bool
+        workers:
+            description: Number of worker processes, or 0 for one per CPU (TF_ANSIBLE_WORKERS).
+            type: int
+        exclude_host_vars:
+            description: Comma separated glob patterns of host var names to leave out (TF_ANSIBLE_EXCLUDE_HOST_VARS).
+            type: str
+        compact:
+            description:
+                - Leave out empty host vars, and set host vars which have the same value on every host of a group
+                  as vars of that group (TF_ANSIBLE_COMPACT).
+            type: bool
+'''
+
+EXAMPLES = '''
+# terraform.yatadis.yml
+plugin: yatadis_inventory
+state:
+  - terraform.tfstate.d
+groups_template: '{{ ["all", "tf_provider_" + provider] | join("\\n") }}'
+host_vars_format: json
+'''
+
+import os
+
+from ansible.errors import AnsibleError, AnsibleParserError
+from ansible.plugins.inventory import BaseInventoryPlugin, Cacheable
+
+try:
+    from yatadis.yatadis import InventoryBuilder
+except ImportError:
+    InventoryBuilder = None
+
+# plugin options, and the InventoryBuilder options they set
+BUILDER_OPTIONS = {
+    'inventory_name_template': 'ansible_inventory_name_template',
+    'groups_template': 'ansible_groups_template',
+    'resource_filter_template': 'ansible_resource_filter_template',
+    'host_vars_template': 'ansible_host_vars_template',
+    'host_vars_format': 'host_vars_format',
+    'output_inventory_name_template': 'ansible_output_inventory_name_template',
+    'output_groups_template': 'ansible_output_groups_template',
+    'output_filter_template': 'ansible_output_filter_template',
+    'output_host_vars_template': 'ansible_output_host_vars_template',
+    'output_host_vars_format': 'output_host_vars_format',
+    'combined_template': 'ansible_combined_template',
+    'output_combined_template': 'ansible_output_combined_template',
+    'combined': 'combined',
+    'workers': 'workers',
+    'exclude_host_vars': 'exclude_host_vars',
+    'compact': 'compact',
+}
+
+class InventoryModule(BaseInventoryPlugin, Cacheable):
+    NAME = 'yatadis_inventory'
+
+    def verify_file(self, path):
+        return super(InventoryModule, self).verify_file(path) and path.endswith(('yatadis.yml', 'yatadis.yaml'))
+
+    def parse(self, inventory, loader, path, cache=True):
+        super(InventoryModule, self).parse(inventory, loader, path, cache)
+        if InventoryBuilder is None:
+            raise AnsibleError("the yatadis_inventory plugin requires the yatadis python package")
+        self._read_config_data(path)
+
+        cache_key = self.get_cache_key(path)
+        user_cache_setting = self.get_option('cache')
+        attempt_to_read_cache = user_cache_setting and cache
+        cache_needs_update = user_cache_setting and not cache
+        inventory_data = None
+        if attempt_to_read_cache:
+            try:
+                inventory_data = self._cache[cache_key]
+            except KeyError:
+                cache_needs_update = True
+        if inventory_data is None:
+            inventory_data = self._build_inventory_data(path)
+        if cache_needs_update:
+            self._cache[cache_key] = inventory_data
+        self._populate(inventory_data)
+
+    def _build_inventory_data(self, path):
+        options = {}
+        for (option, builder_option) in BUILDER_OPTIONS.items():
+            value = self.get_option(option)
+            # unset options fall back to the environment (flags have no
+            # default, so an explicit false still overrides TF_ANSIBLE_*)
+            if value is not None:
+                options[builder_option] = value
+        state = self.get_option('state')
+        if state:
+            state = [os.path.join(os.path.dirname(path), state_spec) for state_spec in state]
+        try:
+            return InventoryBuilder(state, **options).list()
+        except (SystemExit, ValueError, TypeError, OSError) as e:
+            raise AnsibleParserError("yatadis could not build the inventory for %s: %s" % (path, e))
+
+    def _populate(self, inventory_data):
+        for (group_name, group) in inventory_data.items():
+            if group_name == '_meta':
+                continue
+            group_name = self.inventory.add_group(group_name) or group_name
+            for host_name in group.get('hosts', []):
+                self.inventory.add_host(host_name, group=group_name)
+            for (key, value) in group.get('vars', {}).items():
+                self.inventory.set_variable(group_name, key, value)
+        for (host_name, host_vars) in inventory_data['_meta']['hostvars'].items():
+            self.inventory.add_host(host_name)
+            for (key, value) in host_vars.items():
+                self.inventory.set_variable(host_name, key, value)
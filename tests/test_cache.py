@@ -0,0 +1,125 @@
+################################################################################
+# Copyright (c) 2017, 2018 Genome Research Ltd.
+#
+# Author: Joshua C. Randall <jcrandall@alum.mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+from tests.test_output import make_state
+from yatadis import yatadis
+from yatadis.yatadis import InventoryBuilder
+
+GROUPS_TEMPLATE = '{{ "web" if primary.attributes.role is defined else "db" }}'
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, "cache")
+        self.state_path = os.path.join(self.tmp_dir, "c.tfstate")
+        self.write_state({"a": {"role": "web"}, "b": {}})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_state(self, resources):
+        with open(self.state_path, 'w') as f:
+            json.dump(make_state(resources), f)
+
+    def list(self, **options):
+        # the inventory, and the names of the items rendered to build it
+        render_tfstate_item = yatadis.render_tfstate_item
+        with unittest.mock.patch.object(yatadis, 'render_tfstate_item', wraps=render_tfstate_item) as mock:
+            inventory = InventoryBuilder(self.state_path, cache_dir=self.cache_dir, ansible_groups_template=GROUPS_TEMPLATE, **options).list()
+        return (inventory, sorted(call[0][2] for call in mock.call_args_list))
+
+    def age(self, pattern, seconds):
+        then = time.time() - seconds
+        for path in glob.glob(os.path.join(self.cache_dir, pattern)):
+            os.utime(path, (then, then))
+
+    def test_cache_hit(self):
+        (inventory, rendered) = self.list()
+        self.assertEqual(rendered, ["aws_instance.a", "aws_instance.b"])
+        self.assertEqual(self.list(), (inventory, []))
+
+    def test_changed_state(self):
+        self.list()
+        self.write_state({"a": {"role": "web"}, "b": {}, "c": {}})
+        (inventory, rendered) = self.list()
+        self.assertEqual(rendered, ["aws_instance.a", "aws_instance.b", "aws_instance.c"])
+        self.assertEqual(inventory['db']['hosts'], ["aws_instance.b", "aws_instance.c"])
+
+    def test_ttl(self):
+        self.list(cache_ttl=60)
+        self.age("*.json", 30)
+        self.assertEqual(self.list(cache_ttl=60)[1], [])
+        self.age("*.json", 90)
+        self.assertEqual(self.list(cache_ttl=60)[1], ["aws_instance.a", "aws_instance.b"])
+
+    def test_invalidate(self):
+        (inventory, _) = self.list()
+        self.assertEqual(self.list(invalidate_cache=True), (inventory, ["aws_instance.a", "aws_instance.b"]))
+        self.assertEqual(self.list(), (inventory, []))
+
+    def test_one_lock_file_per_state(self):
+        for i in range(3):
+            self.write_state({"a": {"role": "web"}, "b": {"n": str(i)}})
+            self.list()
+        self.assertEqual(len(glob.glob(os.path.join(self.cache_dir, "*.lock"))), 1)
+
+    def test_lock(self):
+        with open(self.state_path, 'r') as f:
+            lock_path = yatadis.get_cache_lock_path(argparse.Namespace(terraform_state=f, cache_dir=self.cache_dir))
+        results = []
+        with yatadis.cache_lock(lock_path):
+            builder = threading.Thread(target=lambda: results.append(self.list()))
+            builder.start()
+            builder.join(0.5)
+            # the builder waits for the lock rather than processing the state
+            self.assertTrue(builder.is_alive())
+            self.assertEqual(results, [])
+        builder.join()
+        self.assertEqual(results[0][1], ["aws_instance.a", "aws_instance.b"])
+
+    def test_prune(self):
+        self.list(incremental=True)
+        (memo_path,) = glob.glob(os.path.join(self.cache_dir, "memo-*.json"))
+        (lock_path,) = glob.glob(os.path.join(self.cache_dir, "*.lock"))
+        (used_bytecode_path,) = glob.glob(os.path.join(self.cache_dir, "template-*.cache"))
+        stale_paths = [os.path.join(self.cache_dir, name) for name in ("stale.json", "template-stale.cache")]
+        for path in stale_paths:
+            with open(path, 'w'):
+                pass
+        self.age("*", 7200)
+        # loading the groups template's bytecode keeps it, and writing the
+        # new entry prunes the stale ones
+        self.write_state({"a": {"role": "web"}})
+        self.list(incremental=True)
+        for path in stale_paths:
+            self.assertFalse(os.path.exists(path), path)
+        for path in (memo_path, lock_path, used_bytecode_path):
+            self.assertTrue(os.path.exists(path), path)
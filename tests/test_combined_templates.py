@@ -0,0 +1,71 @@
+################################################################################
+# Copyright (c) 2017, 2018 Genome Research Ltd.
+#
+# Author: Joshua C. Randall <jcrandall@alum.mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from yatadis.yatadis import InventoryBuilder
+
+STATE = {"version": 3, "modules": [{"path": ["root"], "outputs": {}, "depends_on": [], "resources": {
+    "aws_instance.a": {"type": "aws_instance", "depends_on": [], "primary": {"id": "a", "attributes": {
+        "id": "a", "tags.%": "1", "tags.role": "web", "network.#": "1", "network.0.name": "net"}}},
+    "aws_security_group.b": {"type": "aws_security_group", "depends_on": [], "primary": {"id": "b", "attributes": {"id": "b"}}}}}]}
+
+# templates whose whitespace control depends on where the source starts and
+# ends: indented blocks (lstrip_blocks), and leading and trailing newlines
+# and whitespace
+WHITESPACE_TEMPLATES = (
+    {'ansible_groups_template': '  {% if true %}web{% endif %}'},
+    {'ansible_groups_template': '\n  {% if true %}web{% endif %}\n  '},
+    {'ansible_groups_template': '{% for g in ["a", "b"] %}\n  {{ g }}\n{% endfor %}\n'},
+    {'ansible_resource_filter_template': '  {% if type == "aws_instance" %}True{% else %}False{% endif %}'},
+    {'ansible_inventory_name_template': '  {# name #}\n  {% if true %}{{ name }}{% endif %}  '},
+    {'ansible_host_vars_template': '  {% if true %}\n  a=1\n  {% endif %}\n  b={{ primary.id }}\n'},
+)
+
+class TestCombinedTemplates(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_path = os.path.join(self.tmp_dir, "terraform.tfstate")
+        with open(self.state_path, 'w') as f:
+            json.dump(STATE, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_set_host_var_mapping(self):
+        combined_template = '{{ _yatadis.set_name(name) }}{{ _yatadis.set_host_var("tf", primary.expanded_attributes) }}'
+        inventory = InventoryBuilder(self.state_path, no_cache=True, ansible_combined_template=combined_template).list()
+        self.assertEqual(inventory['_meta']['hostvars']['aws_instance.a']['tf'], {"id": "a", "tags": {"role": "web"}, "network": [{"name": "net"}]})
+
+    def test_set_host_var_unserializable(self):
+        combined_template = '{{ _yatadis.set_name(name) }}{{ _yatadis.set_host_var("t", _yatadis) }}'
+        with self.assertRaises(SystemExit) as context:
+            InventoryBuilder(self.state_path, no_cache=True, ansible_combined_template=combined_template).list()
+        self.assertIn("host_var 't' cannot be output as JSON", str(context.exception))
+
+    def test_generated_combined_template_whitespace(self):
+        for options in WHITESPACE_TEMPLATES:
+            separate = InventoryBuilder(self.state_path, no_cache=True, **options).list()
+            combined = InventoryBuilder(self.state_path, no_cache=True, combined=True, **options).list()
+            self.assertEqual(json.dumps(combined), json.dumps(separate), options)
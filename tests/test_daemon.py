@@ -0,0 +1,81 @@
+################################################################################
+# Copyright (c) 2017, 2018 Genome Research Ltd.
+#
+# Author: Joshua C. Randall <jcrandall@alum.mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from tests.test_output import make_state
+from yatadis.yatadis import InventoryBuilder, InventoryDaemon
+
+class TestInventoryDaemon(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_path = os.path.join(self.tmp_dir, "d.tfstate")
+        self.write_state(make_state({"a": {}}))
+        args = InventoryBuilder(self.state_path, no_cache=True, daemon_poll_interval=0.01).args
+        self.daemon = InventoryDaemon(args, os.path.join(self.tmp_dir, "d.sock"))
+        self.request = {'state': self.daemon.state_key, 'templates': self.daemon.templates_key, 'output': self.daemon.output_key, 'host': None}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_state(self, tf_state):
+        # replace the state as terraform does, so the fingerprint changes
+        # even within the resolution of the file system's mtime
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(tf_state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def served_hosts(self):
+        (status, list_json) = self.daemon.answer(self.request).split("\n", 1)
+        self.assertEqual(status, "OK")
+        return sorted(json.loads(list_json)['_meta']['hostvars'])
+
+    def wait_for_fingerprint(self):
+        deadline = time.time() + 10
+        while self.daemon.state_fingerprint != self.daemon.get_state_fingerprint():
+            self.assertLess(time.time(), deadline, "the daemon did not notice the state change")
+            time.sleep(0.01)
+
+    def test_rebuild_survives_errors(self):
+        self.assertTrue(self.daemon.rebuild())
+        watcher = threading.Thread(target=self.daemon.watch, daemon=True)
+        watcher.start()
+        try:
+            self.assertEqual(self.served_hosts(), ["aws_instance.a"])
+            # a resource without `primary` fails while processing the state,
+            # not while parsing it
+            self.write_state({"version": 3, "modules": [{"path": ["root"], "outputs": {}, "depends_on": [], "resources": {"aws_instance.b": {"type": "aws_instance"}}}]})
+            self.wait_for_fingerprint()
+            self.assertEqual(self.served_hosts(), ["aws_instance.a"])
+            self.assertTrue(watcher.is_alive())
+            self.write_state(make_state({"c": {}}))
+            self.wait_for_fingerprint()
+            self.assertEqual(self.served_hosts(), ["aws_instance.c"])
+        finally:
+            self.daemon.stopped.set()
+            self.daemon.changed.set()
+            watcher.join()
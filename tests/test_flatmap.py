@@ -0,0 +1,142 @@
+################################################################################
+# Copyright (c) 2017, 2018 Genome Research Ltd.
+#
+# Author: Joshua C. Randall <jcrandall@alum.mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+import json
+import random
+import unittest
+
+from yatadis.yatadis import Resource, flatmap_expand
+
+# the flatmap expansion which yatadis used before the trie, kept here as the
+# reference which the trie-based expansion must match exactly
+def reference_flatmap_expand(flatmap, key):
+    if key in flatmap.keys():
+        v = flatmap[key]
+        if v == "true":
+            return True
+        elif v == "false":
+            return False
+        return v
+    if key+'.#' in flatmap.keys():
+        return reference_flatmap_expand_array(flatmap, key)
+    prefix = key+'.'
+    for k in flatmap.keys():
+        if k.startswith(prefix):
+            return reference_flatmap_expand_dict(flatmap, prefix)
+    return None
+
+def reference_flatmap_expand_array(flatmap, prefix):
+    key_set = set()
+    for k in flatmap.keys():
+        if not k.startswith(prefix+'.'):
+            continue
+        key = k[len(prefix)+1:]
+        idx = key.find('.')
+        if idx != -1:
+            key = key[:idx]
+        if key == '#':
+            continue
+        key_set.add(int(key))
+    return [reference_flatmap_expand(flatmap, "%s.%d" % (prefix, key)) for key in sorted(key_set)]
+
+def reference_flatmap_expand_dict(flatmap, prefix):
+    result = {}
+    for k in flatmap.keys():
+        if not k.startswith(prefix):
+            continue
+        key = k[len(prefix):]
+        idx = key.find(".")
+        if idx != -1:
+            key = key[:idx]
+        if key in result or key == '%':
+            continue
+        result[key] = reference_flatmap_expand(flatmap, k[:len(prefix)+len(key)])
+    return result
+
+def random_flatmap(rng, attributes, depth):
+    flatmap = {}
+    for i in range(attributes):
+        add_random_value(rng, flatmap, "attr%d" % (i), depth)
+    return flatmap
+
+def add_random_value(rng, flatmap, key, depth):
+    kind = rng.choice(('string', 'bool', 'list', 'map') if depth > 0 else ('string', 'bool'))
+    if kind == 'string':
+        flatmap[key] = rng.choice(('', 'x', '10.0.0.1', 'a.b', '1'))
+    elif kind == 'bool':
+        flatmap[key] = rng.choice(('true', 'false'))
+    elif kind == 'list':
+        count = rng.randint(0, 12)
+        flatmap[key + '.#'] = str(count)
+        # terraform sets use hashes rather than consecutive indices
+        indices = rng.sample(range(100000), count) if rng.random() < 0.5 else range(count)
+        for index in indices:
+            add_random_value(rng, flatmap, "%s.%d" % (key, index), depth - 1)
+    else:
+        count = rng.randint(0, 4)
+        flatmap[key + '.%'] = str(count)
+        for j in range(count):
+            add_random_value(rng, flatmap, "%s.k%d" % (key, j), depth - 1)
+
+def top_level_prefixes(flatmap):
+    return list(dict.fromkeys(key.split('.')[0] for key in flatmap))
+
+class TestFlatmapExpand(unittest.TestCase):
+    def assert_same_expansion(self, flatmap):
+        for prefix in top_level_prefixes(flatmap):
+            expected = reference_flatmap_expand(flatmap, prefix)
+            actual = flatmap_expand(flatmap, prefix)
+            self.assertEqual(json.dumps(actual), json.dumps(expected), "expanding %s" % (prefix))
+
+    def test_examples(self):
+        self.assert_same_expansion({
+            'id': '1',
+            'enabled': 'true',
+            'disabled': 'false',
+            'network.#': '2',
+            'network.0.name': 'a',
+            'network.0.fixed_ip_v4': '10.0.0.1',
+            'network.1.name': 'b',
+            'network.10.name': 'c',
+            'metadata.%': '2',
+            'metadata.role': 'web',
+            'metadata.tier': 'front',
+            'security_groups.#': '2',
+            'security_groups.3814588639': 'default',
+            'security_groups.1234': 'ssh',
+            'empty.#': '0',
+            'empty_map.%': '0',
+        })
+
+    def test_missing_key(self):
+        self.assertIsNone(flatmap_expand({'a': '1'}, 'b'))
+        self.assertIsNone(flatmap_expand({'a.b': '1'}, 'a.c'))
+
+    def test_random_flatmaps(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            self.assert_same_expansion(random_flatmap(rng, rng.randint(1, 20), 3))
+
+    def test_resource_expanded_attributes(self):
+        rng = random.Random(1)
+        for _ in range(50):
+            flatmap = random_flatmap(rng, rng.randint(1, 20), 3)
+            resource = Resource('aws_instance.a', {'type': 'aws_instance', 'primary': {'id': '1', 'attributes': flatmap}})
+            expected = {prefix: reference_flatmap_expand(flatmap, prefix) for prefix in top_level_prefixes(flatmap)}
+            self.assertEqual(json.dumps(dict(resource['primary']['expanded_attributes'])), json.dumps(expected))
@@ -0,0 +1,107 @@
+################################################################################
+# Copyright (c) 2017, 2018 Genome Research Ltd.
+#
+# Author: Joshua C. Randall <jcrandall@alum.mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from tests.test_output import make_state
+from yatadis import yatadis
+from yatadis.yatadis import InventoryBuilder
+
+RESOURCES = {
+    "a": {"access_ip_v4": "10.0.0.1", "tags.%": "1", "tags.name": "first"},
+    "b": {"access_ip_v4": "10.0.0.2", "tags.%": "1", "tags.name": "sécond ✓"},
+    "c": {"network.#": "2", "network.0.name": "über", "network.1.name": "net"},
+    "d": {},
+}
+
+class TestHostIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, "cache")
+        self.state_path = os.path.join(self.tmp_dir, "h.tfstate")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_state(self, resources, newline='\n', ensure_ascii=True):
+        with open(self.state_path, 'w', encoding='utf-8', newline=newline) as f:
+            f.write(json.dumps(make_state(resources), indent=2, ensure_ascii=ensure_ascii))
+
+    def assert_hosts_from_index(self, seekable):
+        inventory = InventoryBuilder(self.state_path, cache_dir=self.cache_dir).list()
+        host_vars = inventory['_meta']['hostvars']
+        self.assertEqual(sorted(host_vars), ["aws_instance.%s" % (name) for name in sorted(RESOURCES)])
+        read_state_range = yatadis.read_state_range
+        for (inventory_name, expected) in host_vars.items():
+            builder = InventoryBuilder(self.state_path, cache_dir=self.cache_dir)
+            # a small chunk size, so the character-read path reads up to an
+            # item in several chunks
+            with unittest.mock.patch.object(yatadis, 'read_state_range', wraps=read_state_range) as mock, \
+                    unittest.mock.patch.object(yatadis, 'get_inventory_data', side_effect=AssertionError("processed the entire state")), \
+                    unittest.mock.patch.object(yatadis, 'STREAM_CHUNK_SIZE', 7):
+                self.assertEqual(builder.host(inventory_name), expected)
+            self.assertEqual([call[0][3] for call in mock.call_args_list], [seekable])
+
+    def test_ascii_state(self):
+        self.write_state(RESOURCES)
+        self.assert_hosts_from_index(seekable=True)
+
+    def test_non_ascii_state(self):
+        self.write_state(RESOURCES, ensure_ascii=False)
+        self.assert_hosts_from_index(seekable=False)
+
+    def test_crlf_state(self):
+        self.write_state(RESOURCES, newline='\r\n')
+        self.assert_hosts_from_index(seekable=False)
+
+    def test_non_ascii_crlf_state(self):
+        self.write_state(RESOURCES, newline='\r\n', ensure_ascii=False)
+        self.assert_hosts_from_index(seekable=False)
+
+    def test_host_not_in_index(self):
+        self.write_state(RESOURCES)
+        InventoryBuilder(self.state_path, cache_dir=self.cache_dir).list()
+        builder = InventoryBuilder(self.state_path, cache_dir=self.cache_dir)
+        with unittest.mock.patch.object(yatadis, 'read_state_range') as mock, \
+                unittest.mock.patch.object(yatadis, 'get_inventory_data', side_effect=AssertionError("processed the entire state")):
+            self.assertEqual(builder.host("aws_instance.missing"), {})
+        mock.assert_not_called()
+
+    def test_builder_hashes_state_once(self):
+        self.write_state(RESOURCES)
+        host_vars = InventoryBuilder(self.state_path, cache_dir=self.cache_dir).list()['_meta']['hostvars']
+        builder = InventoryBuilder(self.state_path, cache_dir=self.cache_dir)
+        for _ in range(2):
+            get_cache_path = yatadis.get_cache_path
+            read_state_range = yatadis.read_state_range
+            with unittest.mock.patch.object(yatadis, 'get_cache_path', wraps=get_cache_path) as cache_path_mock, \
+                    unittest.mock.patch.object(yatadis, 'read_state_range', wraps=read_state_range) as read_mock:
+                for (inventory_name, expected) in sorted(host_vars.items()):
+                    self.assertEqual(builder.host(inventory_name), expected)
+            # once to look up the first host through the index, and once to
+            # load the inventory for the others
+            self.assertEqual(cache_path_mock.call_count, 2)
+            self.assertEqual(read_mock.call_count, 1)
+            builder.reload()
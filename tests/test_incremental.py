@@ -0,0 +1,124 @@
+################################################################################
+# Copyright (c) 2017, 2018 Genome Research Ltd.
+#
+# Author: Joshua C. Randall <jcrandall@alum.mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+
+import glob
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+from tests.test_output import make_state
+from yatadis import yatadis
+from yatadis.yatadis import InventoryBuilder
+
+def make_host_state(count, changes={}):
+    # resources h0..h<count-1>, whose inventory names are their `host`
+    # attribute, with the attributes of some of them changed or replaced
+    resources = {"h%d" % (i): {"host": "h%d" % (i), "x": "0"} for i in range(count)}
+    for (name, attributes) in changes.items():
+        if attributes is None:
+            del resources[name]
+        else:
+            resources[name] = dict(resources.get(name, {"host": name}), **attributes)
+    return make_state(resources)
+
+HOST_INVENTORY_NAME_TEMPLATE = '{{ primary.attributes.host }}'
+
+class TestIncremental(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, "cache")
+        self.state_path = os.path.join(self.tmp_dir, "i.tfstate")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_state(self, resources):
+        with open(self.state_path, 'w') as f:
+            json.dump(make_state(resources), f)
+
+    def rendered_items(self, **options):
+        # the names of the items rendered (rather than reused from the memo)
+        # by a serial incremental run
+        render_tfstate_item = yatadis.render_tfstate_item
+        with unittest.mock.patch.object(yatadis, 'render_tfstate_item', wraps=render_tfstate_item) as mock:
+            InventoryBuilder(self.state_path, incremental=True, cache_dir=self.cache_dir, workers=1, **options).list()
+        return sorted(call[0][2] for call in mock.call_args_list)
+
+    def test_memo_does_not_expire(self):
+        self.write_state({"a": {"x": "1"}, "b": {"x": "2"}})
+        self.assertEqual(self.rendered_items(cache_ttl=3600), ["aws_instance.a", "aws_instance.b"])
+        (memo_path,) = glob.glob(os.path.join(self.cache_dir, "memo-*.json"))
+        # as if the last apply was a day ago
+        day_ago = time.time() - 86400
+        os.utime(memo_path, (day_ago, day_ago))
+        self.write_state({"a": {"x": "1"}, "b": {"x": "3"}})
+        self.assertEqual(self.rendered_items(cache_ttl=3600), ["aws_instance.b"])
+        # storing other cache entries does not prune the memo
+        os.utime(memo_path, (day_ago, day_ago))
+        self.write_state({"a": {"x": "1"}, "b": {"x": "3"}, "c": {}})
+        yatadis.store_cached_tfstate_data(os.path.join(self.cache_dir, "other.json"), {}, 3600)
+        self.assertTrue(os.path.exists(memo_path))
+        self.assertEqual(self.rendered_items(cache_ttl=3600), ["aws_instance.c"])
+
+    def test_memo_depends_on_cache_format_version(self):
+        self.write_state({"a": {}, "b": {}})
+        self.rendered_items()
+        self.write_state({"a": {}, "b": {}, "c": {}})
+        with unittest.mock.patch.object(yatadis, 'CACHE_FORMAT_VERSION', yatadis.CACHE_FORMAT_VERSION + 1):
+            self.assertEqual(self.rendered_items(), ["aws_instance.a", "aws_instance.b", "aws_instance.c"])
+
+    def write_list(self, **options):
+        f = io.StringIO()
+        InventoryBuilder(self.state_path, no_cache=True, cache_dir=self.cache_dir, ansible_inventory_name_template=HOST_INVENTORY_NAME_TEMPLATE, **options).write_list(f)
+        return f.getvalue()
+
+    def assert_same_as_cold(self, workers, tf_state):
+        with open(self.state_path, 'w') as f:
+            json.dump(tf_state, f)
+        try:
+            cold = self.write_list(workers=1)
+        except SystemExit as e:
+            with self.assertRaises(SystemExit) as context:
+                self.write_list(incremental=True, workers=workers)
+            self.assertEqual(str(context.exception), str(e))
+            return
+        self.assertEqual(self.write_list(incremental=True, workers=workers), cold)
+
+    def test_memoized_results_in_order(self):
+        for workers in (1, 3):
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            # several chunks, so rendered results come back from different
+            # workers between the memoized ones
+            with unittest.mock.patch.object(yatadis, 'PARALLEL_CHUNK_SIZE', 4):
+                self.assert_same_as_cold(workers, make_host_state(40))
+                self.assert_same_as_cold(workers, make_host_state(40, {"h0": {"x": "1"}, "h17": {"x": "1"}, "h18": {"x": "1"}, "h25": None, "h39": {"x": "1"}, "n": {}}))
+                # duplicates of memoized hosts, by earlier and later items
+                self.assert_same_as_cold(workers, make_host_state(40, {"h5": {"host": "h30"}}))
+                self.assert_same_as_cold(workers, make_host_state(40, {"h30": {"host": "h5"}}))
+                with self.assertRaises(SystemExit) as context:
+                    self.write_list(incremental=True, workers=workers)
+                self.assertIn("'h5' was a duplicate", str(context.exception))
+                # and the memo is still usable after a failed run
+                self.assert_same_as_cold(workers, make_host_state(40, {"h1": {"x": "2"}}))
@@ -0,0 +1,87 @@
+################################################################################
+# Copyright (c) 2017, 2018 Genome Research Ltd.
+#
+# Author: Joshua C. Randall <jcrandall@alum.mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from tests.test_flatmap import random_flatmap
+from yatadis.yatadis import (InventoryBuilder, DEFAULT_ANSIBLE_GROUPS_TEMPLATE, DEFAULT_ANSIBLE_HOST_VARS_TEMPLATE,
+                             DEFAULT_ANSIBLE_INVENTORY_NAME_TEMPLATE, DEFAULT_ANSIBLE_OUTPUT_FILTER_TEMPLATE,
+                             DEFAULT_ANSIBLE_RESOURCE_FILTER_TEMPLATE)
+
+RESOURCE_TYPES = ("aws_instance", "openstack_compute_instance_v2", "google_compute_instance", "aws_security_group", "null_resource")
+HOST_ATTRIBUTES = ("access_ip_v4", "access_ip_v6", "private_ip", "network.0.fixed_ip_v4", "ipv4_address")
+HOST_ADDRESSES = ("10.0.0.1", "fe80::1", "", "[1, 2]", "{'a': 1}", "with space")
+
+def random_state(rng, resources):
+    module_resources = {}
+    for i in range(resources):
+        resource_type = rng.choice(RESOURCE_TYPES)
+        attributes = random_flatmap(rng, rng.randint(0, 8), 2)
+        for attr in rng.sample(HOST_ATTRIBUTES, rng.randint(0, 2)):
+            attributes[attr] = rng.choice(HOST_ADDRESSES)
+        attributes["id"] = str(i)
+        module_resources["%s.r%d" % (resource_type, i)] = {"type": resource_type, "depends_on": [], "primary": {"id": str(i), "attributes": attributes}}
+    outputs = {"out": {"type": "string", "value": "x"}}
+    return {"version": 3, "modules": [{"path": ["root"], "outputs": outputs, "resources": module_resources, "depends_on": []}]}
+
+class TestNativeTemplates(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = random.Random(0)
+        self.state_paths = []
+        for i in range(5):
+            state_path = os.path.join(self.tmp_dir, "state%d.tfstate" % (i))
+            with open(state_path, 'w') as f:
+                json.dump(random_state(rng, 30), f)
+            self.state_paths.append(state_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def assert_same_as_jinja(self, **options):
+        for state_path in self.state_paths:
+            native = InventoryBuilder(state_path, no_cache=True, workers=1, **options).list()
+            jinja = InventoryBuilder(state_path, no_cache=True, workers=1, force_jinja=True, **options).list()
+            self.assertEqual(json.dumps(native), json.dumps(jinja), "%s with %s" % (state_path, options))
+
+    def test_default_templates(self):
+        self.assert_same_as_jinja()
+
+    def test_default_templates_combined(self):
+        self.assert_same_as_jinja(combined=True)
+
+    def test_default_json_host_vars(self):
+        self.assert_same_as_jinja(host_vars_format='json')
+
+    def test_outputs(self):
+        self.assert_same_as_jinja(ansible_output_filter_template='True', ansible_output_groups_template='outputs')
+
+    def test_default_sources_in_other_templates(self):
+        # a default source given for a different template is rendered as what
+        # it is in that template
+        for source in (DEFAULT_ANSIBLE_GROUPS_TEMPLATE, DEFAULT_ANSIBLE_OUTPUT_FILTER_TEMPLATE, DEFAULT_ANSIBLE_INVENTORY_NAME_TEMPLATE, DEFAULT_ANSIBLE_RESOURCE_FILTER_TEMPLATE):
+            self.assert_same_as_jinja(ansible_host_vars_template=source)
+        self.assert_same_as_jinja(ansible_groups_template=DEFAULT_ANSIBLE_INVENTORY_NAME_TEMPLATE)
+        self.assert_same_as_jinja(ansible_groups_template=DEFAULT_ANSIBLE_HOST_VARS_TEMPLATE)
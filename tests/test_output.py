@@ -0,0 +1,79 @@
+################################################################################
+# Copyright (c) 2017, 2018 Genome Research Ltd.
+#
+# Author: Joshua C. Randall <jcrandall@alum.mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from yatadis.yatadis import InventoryBuilder
+
+YATADIS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'yatadis', 'yatadis.py')
+
+def make_state(resources):
+    return {"version": 3, "modules": [{"path": ["root"], "outputs": {}, "depends_on": [], "resources": {
+        "aws_instance.%s" % (name): {"type": "aws_instance", "depends_on": [], "primary": {"id": name, "attributes": dict(attributes, id=name)}}
+        for (name, attributes) in resources.items()}}]}
+
+class TestOutput(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_path = os.path.join(self.tmp_dir, "g.tfstate")
+        with open(self.state_path, 'w') as f:
+            json.dump(make_state({"h0": {"role": "web", "empty": ""}, "h1": {"role": "web"}, "h2": {}}), f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def effective_host_vars(self, inventory):
+        # the vars of each host as ansible sees them, with group vars applied
+        # (the vars of `all` to every host)
+        host_vars = {}
+        for (inventory_name, own_vars) in inventory['_meta']['hostvars'].items():
+            host_vars[inventory_name] = dict(inventory.get('all', {}).get('vars', {}))
+            for (group_name, group) in inventory.items():
+                if group_name not in ('_meta', 'all') and inventory_name in group['hosts']:
+                    host_vars[inventory_name].update(group.get('vars', {}))
+            host_vars[inventory_name].update(own_vars)
+        return host_vars
+
+    def test_write_list_json(self):
+        builder = InventoryBuilder(self.state_path, no_cache=True)
+        f = io.StringIO()
+        builder.write_list(f)
+        self.assertEqual(f.getvalue(), json.dumps(builder.list()) + "\n")
+
+    def test_compact_keeps_effective_host_vars(self):
+        for groups_template in ('all', '{{ "all" if primary.attributes.role is defined else "db" }}', '{{ "web" if primary.attributes.role is defined else "db" }}'):
+            full = InventoryBuilder(self.state_path, no_cache=True, ansible_groups_template=groups_template).list()
+            compact = InventoryBuilder(self.state_path, no_cache=True, ansible_groups_template=groups_template, compact=True).list()
+            expected = {inventory_name: {key: value for (key, value) in host_vars.items() if value != ""}
+                        for (inventory_name, host_vars) in self.effective_host_vars(full).items()}
+            self.assertEqual(self.effective_host_vars(compact), expected, groups_template)
+
+    def test_invalid_host_var_writes_no_output(self):
+        result = subprocess.run([sys.executable, YATADIS, '--list', '--state', self.state_path, '--ansible-no-cache', '--ansible-no-daemon', '--ansible-host-vars-template', 'x={1, 2}'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertEqual(result.stdout, "")
+        self.assertIn("x={1, 2}", result.stderr)
@@ -0,0 +1,66 @@
+################################################################################
+# Copyright (c) 2017, 2018 Genome Research Ltd.
+#
+# Author: Joshua C. Randall <jcrandall@alum.mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from tests.test_native_templates import random_state
+from yatadis import yatadis
+from yatadis.yatadis import InventoryBuilder
+
+class TestParallel(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_path = os.path.join(self.tmp_dir, "p.tfstate")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_list(self, workers, **options):
+        f = io.StringIO()
+        InventoryBuilder(self.state_path, no_cache=True, workers=workers, **options).write_list(f)
+        return f.getvalue()
+
+    def test_same_as_serial(self):
+        with open(self.state_path, 'w') as f:
+            json.dump(random_state(random.Random(1), 100), f)
+        for options in ({}, {'combined': True}, {'ansible_groups_template': '{{ type }}\n{{ "x" if primary.id|int % 2 else "y" }}'}):
+            with unittest.mock.patch.object(yatadis, 'PARALLEL_CHUNK_SIZE', 8):
+                self.assertEqual(self.write_list(3, **options), self.write_list(1, **options), options)
+
+    def test_duplicate_inventory_name_in_later_chunk(self):
+        with open(self.state_path, 'w') as f:
+            json.dump(random_state(random.Random(2), 40), f)
+        # every resource from the 30th on is named "dup", so the first
+        # duplicate is the 31st item, in the 8th chunk of 4
+        options = {'ansible_inventory_name_template': '{{ "dup" if primary.id|int >= 30 else name }}'}
+        with self.assertRaises(SystemExit) as serial:
+            self.write_list(1, **options)
+        self.assertIn("'dup' was a duplicate", str(serial.exception))
+        with unittest.mock.patch.object(yatadis, 'PARALLEL_CHUNK_SIZE', 4):
+            with self.assertRaises(SystemExit) as parallel:
+                self.write_list(3, **options)
+        self.assertEqual(str(parallel.exception), str(serial.exception))
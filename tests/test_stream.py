@@ -0,0 +1,85 @@
+################################################################################
+# Copyright (c) 2017, 2018 Genome Research Ltd.
+#
+# Author: Joshua C. Randall <jcrandall@alum.mit.edu>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+
+import io
+import json
+import random
+import unittest
+
+from yatadis.yatadis import JsonStream, iter_stream_tfstate_items, iter_tfstate_items, stream_tfstate_items
+
+def random_value(rng, depth):
+    kind = rng.choice(('string', 'number', 'literal', 'list', 'object') if depth > 0 else ('string', 'number', 'literal'))
+    if kind == 'string':
+        return rng.choice(('', 'plain', 'with "quotes"', 'back\\slash', 'braces {[', 'new\nline', 'unicodé ☃', 'tab\t', '😀'))
+    elif kind == 'number':
+        return rng.choice((0, -1, 42, 3.5, 1e100, -2.25e-7))
+    elif kind == 'literal':
+        return rng.choice((True, False, None))
+    elif kind == 'list':
+        return [random_value(rng, depth - 1) for _ in range(rng.randint(0, 4))]
+    return {"k%d" % (i): random_value(rng, depth - 1) for i in range(rng.randint(0, 4))}
+
+def random_state(rng):
+    modules = []
+    for m in range(rng.randint(1, 3)):
+        module = {
+            "path": ["root"] + ["m%d" % (m)] * (m > 0),
+            "outputs": {"out%d" % (i): {"type": "string", "value": random_value(rng, 2)} for i in range(rng.randint(0, 3))},
+            "resources": {"aws_instance.r%d" % (i): {"type": "aws_instance", "depends_on": [], "primary": {"id": str(i), "attributes": {"id": str(i), "tags.%": "1", "tags.x": random_value(rng, 0)}, "meta": random_value(rng, 3)}} for i in range(rng.randint(0, 5))},
+            "depends_on": [],
+        }
+        modules.append(module)
+    return {"version": 3, "terraform_version": "0.11.7", "serial": rng.randint(1, 100), "lineage": "x", "modules": modules}
+
+def read_items(text, chunk_size=None):
+    if chunk_size is None:
+        return list(stream_tfstate_items(io.StringIO(text)))
+    return list(iter_stream_tfstate_items(JsonStream(io.StringIO(text), chunk_size=chunk_size)))
+
+class TestStreamTfstateItems(unittest.TestCase):
+    def assert_same_items(self, text):
+        expected = list(iter_tfstate_items(json.loads(text)))
+        for chunk_size in (None, 1, 2, 7, 64):
+            self.assertEqual(read_items(text, chunk_size), expected, "with chunk size %s" % (chunk_size))
+
+    def test_random_states(self):
+        rng = random.Random(0)
+        for _ in range(100):
+            state = random_state(rng)
+            self.assert_same_items(json.dumps(state))
+            self.assert_same_items(json.dumps(state, indent=2, ensure_ascii=False))
+
+    def test_other_keys(self):
+        rng = random.Random(1)
+        state = random_state(rng)
+        for module in state["modules"]:
+            module["path"] = module.pop("path")
+            module["extra"] = {"resources": {"aws_instance.not_an_item": {}}}
+        state["after_modules"] = {"modules": []}
+        self.assert_same_items(json.dumps(state))
+
+    def test_items_in_file_order(self):
+        text = '{"modules": [{"path": ["root"], "resources": {"aws_instance.a": {}}, "outputs": {"b": {}}}]}'
+        self.assertEqual(read_items(text), [("resource", "aws_instance.a", {}), ("output", "b", {})])
+
+    def test_empty_modules(self):
+        self.assert_same_items('{"version": 3, "modules": []}')
+        self.assert_same_items('{"version": 3, "modules": [{"path": ["root"], "outputs": {}, "resources": {}}]}')
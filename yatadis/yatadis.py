@@ -19,17 +19,30 @@
 ################################################################################
 
 import argparse
-import ast
+import collections
+import collections.abc
+import contextlib
+import fnmatch
+import glob
+import hashlib
+import itertools
 import json
 import os
 import re
+import stat
 import sys
+import time
 import types
 
-from jinja2 import Template
-from jinja2 import exceptions as jinja_exc
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-from jinjath import TemplateWithSource, JinjaTemplateAction, set_template_kwargs
+# jinja2 (along with jinjath) is only imported once a template is compiled
+# (see "Template compilation" below). Until then no Jinja template can have
+# been rendered, so there are no Jinja exceptions to catch.
+jinja_exc = types.SimpleNamespace(UndefinedError=())
 
 ###############################################################################
 # Default inventory name template:
@@ -82,6 +95,25 @@ DEFAULT_ANSIBLE_RESOURCE_FILTER_TEMPLATE="""{{ type in [
                                                "triton_machine",
                                                "vsphere_virtual_machine"] }}"""
 
+# the same list of types, used by the native implementation of the default
+# resource filter template (see NativeResourceTypeFilterTemplate)
+DEFAULT_ANSIBLE_RESOURCE_TYPES = frozenset([
+    "alicloud_instance",
+    "aws_instance",
+    "clc_server",
+    "cloudstack_instance",
+    "digitalocean_droplet",
+    "docker_container",
+    "google_compute_instance",
+    "azurem_virtual_machine",
+    "azure_instance",
+    "openstack_compute_instance_v2",
+    "profitbricks_server",
+    "scaleway_server",
+    "softlayer_virtual_guest",
+    "triton_machine",
+    "vsphere_virtual_machine"])
+
 ###############################################################################
 # Default host vars template:
 # set all primary attributes as host_vars prefixed by 'tf_' and set `host_name`
@@ -131,6 +163,63 @@ DEFAULT_ANSIBLE_HOST_VARS_TEMPLATE="""ansible_host={{ primary.attributes.access_
                                       {%- endfor -%}
                                       """
 
+# the same `default(..., true)` chain of primary attributes, in order, used by
+# the native implementation of the default host vars template (see
+# NativeDefaultHostVarsTemplate)
+DEFAULT_ANSIBLE_HOST_ATTRIBUTES = (
+    "access_ip_v6",
+    "ipv6_address",
+    "access_ip_v4",
+    "network.0.floating_ip",
+    "network_interface.0.access_config.0.assigned_nat_ip",
+    "ipv4_address",
+    "public_ip",
+    "ipaddress",
+    "vip_address",
+    "primaryip",
+    "ip_address",
+    "network_interface.0.ipv6_address",
+    "ipv6_address_private",
+    "private_ip",
+    "network_interface.0.ipv4_address",
+    "private_ip_address",
+    "ipv4_address_private",
+    "network_interface.0.address",
+    "network.0.fixed_ip_v6",
+    "network.0.fixed_ip_v4")
+
+###############################################################################
+# Default JSON host vars template:
+# used instead of the default host vars template when the host vars format is
+# 'json'. It sets the same host_vars, but renders them as a single JSON object
+# so that lists, maps and multi-line values keep their types and content.
+###############################################################################
+DEFAULT_ANSIBLE_HOST_VARS_JSON_TEMPLATE="""{"ansible_host": {{ primary.attributes.access_ip_v6
+                                                | default(primary.attributes.ipv6_address, true)
+                                                | default(primary.attributes.access_ip_v4, true)
+                                                | default(primary.attributes["network.0.floating_ip"], true)
+                                                | default(primary.attributes["network_interface.0.access_config.0.assigned_nat_ip"], true)
+                                                | default(primary.attributes.ipv4_address, true)
+                                                | default(primary.attributes.public_ip, true)
+                                                | default(primary.attributes.ipaddress, true)
+                                                | default(primary.attributes.vip_address, true)
+                                                | default(primary.attributes.primaryip, true)
+                                                | default(primary.attributes.ip_address, true)
+                                                | default(primary.attributes["network_interface.0.ipv6_address"], true)
+                                                | default(primary.attributes.ipv6_address_private, true)
+                                                | default(primary.attributes.private_ip, true)
+                                                | default(primary.attributes["network_interface.0.ipv4_address"], true)
+                                                | default(primary.attributes.private_ip_address, true)
+                                                | default(primary.attributes.ipv4_address_private, true)
+                                                | default(primary.attributes["network_interface.0.address"], true)
+                                                | default(primary.attributes["network.0.fixed_ip_v6"], true)
+                                                | default(primary.attributes["network.0.fixed_ip_v4"], true)
+                                                | default("", true) | tojson }}
+                                      {%- for attr, value in primary.expanded_attributes.items() -%}
+                                        , {{ ("tf_" ~ attr) | tojson }}: {{ value | tojson }}
+                                      {%- endfor -%}
+                                      }"""
+
 ###############################################################################
 # Default inventory name template for terraform outputs:
 # names the ansible `inventory_name` after the Terraform output name
@@ -147,7 +236,7 @@ DEFAULT_ANSIBLE_OUTPUT_GROUPS_TEMPLATE='all'
 # Default resource filter for terraform outputs:
 # exclude all outputs from ansible inventory
 ###############################################################################
-DEFAULT_ANSIBLE_OUTPUT_RESOURCE_FILTER_TEMPLATE='False'
+DEFAULT_ANSIBLE_OUTPUT_FILTER_TEMPLATE='False'
 
 ###############################################################################
 # Default host vars template for terraform outputs:
@@ -155,64 +244,499 @@ DEFAULT_ANSIBLE_OUTPUT_RESOURCE_FILTER_TEMPLATE='False'
 ###############################################################################
 DEFAULT_ANSIBLE_OUTPUT_HOST_VARS_TEMPLATE=''
 
-set_template_kwargs({'trim_blocks': True, 'lstrip_blocks': True, 'autoescape': False})
+###############################################################################
+# Inventory cache:
+# the processed groups and hosts are cached on disk under a key derived from
+# the state file fingerprint and the source of every template, so repeated
+# invocations by ansible against an unchanged state skip parsing and rendering.
+# CACHE_FORMAT_VERSION is part of the templates key (and so of every cache key
+# and render memo digest), and is increased whenever a change to yatadis
+# changes what is rendered or cached.
+###############################################################################
+CACHE_FORMAT_VERSION = 3
+DEFAULT_CACHE_TTL = 3600
+DEFAULT_CACHE_DIR = os.path.join(os.getenv('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'yatadis')
+
+# argparse destinations of all templates, in a fixed order
+TEMPLATE_ARGS = (
+    'ansible_resource_filter_template',
+    'ansible_inventory_name_template',
+    'ansible_groups_template',
+    'ansible_host_vars_template',
+    'ansible_output_filter_template',
+    'ansible_output_inventory_name_template',
+    'ansible_output_groups_template',
+    'ansible_output_host_vars_template',
+)
+
+# argparse destinations of the format of each host vars template
+HOST_VARS_FORMAT_ARGS = {
+    'ansible_host_vars_template': 'host_vars_format',
+    'ansible_output_host_vars_template': 'output_host_vars_format',
+}
+HOST_VARS_FORMATS = ('text', 'json')
+
+TEMPLATE_KWARGS = {'trim_blocks': True, 'lstrip_blocks': True, 'autoescape': False}
+
+###############################################################################
+# Timings:
+# when enabled (with `--timings`), the wall and CPU time spent in each phase
+# of processing is accumulated in a Timings object. Phases nest, and the time
+# of each phase excludes that of the phases nested within it (e.g. attribute
+# expansion triggered while rendering the host vars template is counted as
+# `expand`, not `render_host_vars`). When disabled, `_timings` is None and
+# each instrumented point costs a single truth test.
+###############################################################################
+TIMINGS_PHASES = ('parse', 'construct', 'expand', 'render_filter', 'render_inventory_name', 'render_groups', 'render_host_vars', 'merge', 'output')
+
+_timings = None
+
+class Timings(object):
+    def __init__(self, slowest=0):
+        self.phases = {}
+        self.counts = collections.Counter()
+        self.slowest = slowest
+        self.slowest_items = []
+        self._stack = []
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+    def start(self):
+        # [wall start, cpu start, wall of nested phases, cpu of nested phases]
+        self._stack.append([time.perf_counter(), time.process_time(), 0.0, 0.0])
+
+    def stop(self, phase):
+        (wall_start, cpu_start, nested_wall, nested_cpu) = self._stack.pop()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        self.add(phase, wall - nested_wall, cpu - nested_cpu)
+        if self._stack:
+            self._stack[-1][2] += wall
+            self._stack[-1][3] += cpu
+        return wall
+
+    def add(self, phase, wall, cpu, calls=1):
+        totals = self.phases.setdefault(phase, [0.0, 0.0, 0])
+        totals[0] += wall
+        totals[1] += cpu
+        totals[2] += calls
+
+    def count(self, name):
+        self.counts[name] += 1
+
+    def item(self, wall, item_type, item_name):
+        if self.slowest > 0:
+            import heapq
+            heapq.heappush(self.slowest_items, (wall, item_type, item_name))
+            if len(self.slowest_items) > self.slowest:
+                heapq.heappop(self.slowest_items)
+
+    def merge(self, timings_data):
+        # merges the `as_dict` of another Timings (e.g. from a worker process)
+        for (phase, totals) in timings_data['phases'].items():
+            self.add(phase, totals['wall'], totals['cpu'], totals['calls'])
+        self.counts.update(timings_data['counts'])
+        for slow_item in timings_data['slowest']:
+            self.item(slow_item['wall'], slow_item['type'], slow_item['name'])
+
+    def as_dict(self):
+        return {
+            'total': {'wall': time.perf_counter() - self._wall_start, 'cpu': time.process_time() - self._cpu_start},
+            'phases': {phase: {'wall': wall, 'cpu': cpu, 'calls': calls} for (phase, (wall, cpu, calls)) in self.phases.items()},
+            'counts': dict(self.counts),
+            'slowest': [{'wall': wall, 'type': item_type, 'name': item_name} for (wall, item_type, item_name) in sorted(self.slowest_items, reverse=True)],
+        }
+
+    def report(self, f):
+        timings_data = self.as_dict()
+        print("yatadis timings (wall / cpu seconds):", file=f)
+        phases = [phase for phase in TIMINGS_PHASES if phase in timings_data['phases']]
+        phases.extend(sorted(phase for phase in timings_data['phases'] if phase not in TIMINGS_PHASES))
+        for phase in phases:
+            totals = timings_data['phases'][phase]
+            print("  %-24s %10.4f %10.4f  (%d calls)" % (phase, totals['wall'], totals['cpu'], totals['calls']), file=f)
+        print("  %-24s %10.4f %10.4f" % ('total', timings_data['total']['wall'], timings_data['total']['cpu']), file=f)
+        for (name, count) in sorted(timings_data['counts'].items()):
+            print("  %-24s %10d" % (name, count), file=f)
+        if timings_data['slowest']:
+            print("slowest items (wall seconds):", file=f)
+            for slow_item in timings_data['slowest']:
+                print("  %10.4f  %s %s" % (slow_item['wall'], slow_item['type'], slow_item['name']), file=f)
+
+def enable_timings(slowest=0):
+    global _timings
+    _timings = Timings(slowest=slowest)
+    return _timings
+
+def iter_timed_items(timings, items):
+    items = iter(items)
+    while True:
+        timings.start()
+        try:
+            item = next(items)
+        except StopIteration:
+            timings.stop('parse')
+            return
+        timings.stop('parse')
+        yield item
 
 def process_tfstate(args, tf_state):
+    return process_tfstate_items(args, iter_tfstate_items(tf_state, debug_p=args.debug))
+
+def process_tfstate_stream(args, tf_state_file, host_index=None):
+    args.debug and print("Streaming JSON from %s" % (tf_state_file.name), file=sys.stderr)
+    return process_tfstate_items(args, stream_tfstate_items(tf_state_file, debug_p=args.debug, host_index=host_index), host_index=host_index)
+
+def process_tfstate_items(args, items, host_index=None):
     tfstate_data = {}
     groups = {}
     hosts = {}
+    timings = _timings
+    if timings:
+        items = iter_timed_items(timings, items)
+    memo_path = None
+    if args.incremental:
+        memo_path = get_render_memo_path(args)
+        # the memo is content-addressed, so it never expires: it has to last
+        # from one terraform apply to the next
+        old_memo = load_cached_tfstate_data(memo_path, None) or {}
+        new_memo = {}
+        items = MemoizedItems(args, items, old_memo, new_memo)
+    if args.workers != 1:
+        item_results = iter_parallel_item_results(args, items)
+    else:
+        item_results = (process_tfstate_item(args, *item) for item in items)
+    if memo_path is not None:
+        item_results = iter_memoized_item_results(item_results, items)
+    for (item_groups, item_hosts) in item_results:
+        timings and timings.start()
+        merge_groups_into(groups, item_groups)
+        merge_hosts_into(hosts, item_hosts)
+        host_index is not None and host_index.add_result(item_hosts)
+        timings and timings.stop('merge')
+    if memo_path is not None:
+        args.debug and print("Storing %d memoized item results in %s" % (len(new_memo), memo_path), file=sys.stderr)
+        store_cached_tfstate_data(memo_path, new_memo, args.cache_ttl)
+
+    tfstate_data['groups'] = groups
+    tfstate_data['hosts'] = hosts
+    return tfstate_data
+
+def process_tfstate_item(args, item_type, item_name, item_dict):
+    timings = _timings
+    if not timings:
+        return render_tfstate_item(args, item_type, item_name, item_dict)
+    timings.start()
+    result = render_tfstate_item(args, item_type, item_name, item_dict)
+    timings.item(timings.stop('construct'), item_type, item_name)
+    return result
+
+def render_tfstate_item(args, item_type, item_name, item_dict):
+    if item_type == "output":
+        item = Output(item_name, item_dict)
+        if args.output_combined_template is not None:
+            return process_item_with_combined_template(item=item, item_type=item_type, item_name=item_name, combined_template=args.output_combined_template, filter_template=args.ansible_output_filter_template, inventory_name_template=args.ansible_output_inventory_name_template, groups_template=args.ansible_output_groups_template, host_vars_template=args.ansible_output_host_vars_template, debug_p=args.debug)
+        return process_item_with_templates(item=item, item_type=item_type, item_name=item_name, filter_template=args.ansible_output_filter_template, inventory_name_template=args.ansible_output_inventory_name_template, groups_template=args.ansible_output_groups_template, host_vars_template=args.ansible_output_host_vars_template, debug_p=args.debug)
+    else:
+        item = Resource(item_name, item_dict)
+        if args.resource_combined_template is not None:
+            return process_item_with_combined_template(item=item, item_type=item_type, item_name=item_name, combined_template=args.resource_combined_template, filter_template=args.ansible_resource_filter_template, inventory_name_template=args.ansible_inventory_name_template, groups_template=args.ansible_groups_template, host_vars_template=args.ansible_host_vars_template, debug_p=args.debug)
+        return process_item_with_templates(item=item, item_type=item_type, item_name=item_name, filter_template=args.ansible_resource_filter_template, inventory_name_template=args.ansible_inventory_name_template, groups_template=args.ansible_groups_template, host_vars_template=args.ansible_host_vars_template, debug_p=args.debug)
+
+###############################################################################
+# Parallel rendering:
+# items are sent in chunks to a pool of worker processes, each of which
+# compiles the templates once and returns the (groups, hosts) of every item in
+# the chunk. Results are merged in the original item order, so the output
+# (including which inventory_name is reported as a duplicate) is identical to
+# serial processing.
+###############################################################################
+PARALLEL_CHUNK_SIZE = 64
+
+_parallel_worker_args = None
+_parallel_worker_timings_slowest = None
+
+def get_parallel_workers(args):
+    return args.workers or os.cpu_count() or 1
+
+def make_parallel_executor(args, workers):
+    # the templates are sent to each worker as their sources (and compiled
+    # once per worker), along with all other arguments except the open state
+    # file
+    template_sources = {template_arg: getattr(args, template_arg).source() for template_arg in TEMPLATE_ARGS}
+    for template_arg in COMBINED_TEMPLATE_ARGS:
+        template = getattr(args, template_arg)
+        template_sources[template_arg] = template and template.source()
+    excluded_args = set(TEMPLATE_ARGS) | set(COMBINED_TEMPLATE_ARGS) | {'resource_combined_template', 'output_combined_template', 'terraform_state'}
+    settings = {key: value for (key, value) in vars(args).items() if key not in excluded_args}
+    import concurrent.futures
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_parallel_worker, initargs=(template_sources, settings, _timings and _timings.slowest))
+
+def iter_parallel_item_results(args, items):
+    workers = get_parallel_workers(args)
+    args.debug and print("Rendering items in parallel using %d worker processes" % (workers), file=sys.stderr)
+    with make_parallel_executor(args, workers) as executor:
+        pending = collections.deque()
+        try:
+            items = iter(items)
+            while True:
+                chunk = list(itertools.islice(items, PARALLEL_CHUNK_SIZE))
+                if chunk:
+                    pending.append(executor.submit(process_tfstate_item_chunk, chunk))
+                # keep a bounded number of chunks in flight so a streamed
+                # state is never read far ahead of the merge
+                if pending and (not chunk or len(pending) >= 2 * workers):
+                    (results, timings_data) = pending.popleft().result()
+                    if timings_data is not None:
+                        _timings.merge(timings_data)
+                    for result in results:
+                        if isinstance(result, BaseException):
+                            raise result
+                        yield result
+                elif not chunk:
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+
+def init_parallel_worker(template_sources, settings, timings_slowest):
+    global _parallel_worker_args, _parallel_worker_timings_slowest
+    _parallel_worker_timings_slowest = timings_slowest
+    templates = {}
+    for (template_arg, source) in template_sources.items():
+        templates[template_arg] = LazyTemplate(source) if source is not None else None
+    _parallel_worker_args = argparse.Namespace(**dict(settings, debug=False, workers=1), **templates)
+    prepare_templates(_parallel_worker_args)
+    _parallel_worker_args.debug = settings['debug']
+
+def process_tfstate_item_chunk(chunk):
+    # returns the results of the items in the chunk together with the timings
+    # of rendering them, if timings are enabled
+    timings = None
+    if _parallel_worker_timings_slowest is not None:
+        timings = enable_timings(slowest=_parallel_worker_timings_slowest)
+    results = []
+    for (item_type, item_name, item_dict) in chunk:
+        try:
+            results.append(process_tfstate_item(_parallel_worker_args, item_type, item_name, item_dict))
+        except BaseException as e:
+            # returned rather than raised so that the parent re-raises it only
+            # after merging the results of all earlier items
+            results.append(e)
+            break
+    return (results, timings and timings.as_dict())
+
+###############################################################################
+# Incremental rendering:
+# the (groups, hosts) result of each item is memoized on disk under a digest
+# of the template sources and the item's content, so that on the next run only
+# items which have changed are rendered again. Unchanged items are skipped by
+# the renderer and their stored results are spliced back into the result
+# stream in their original position, so that merging (and the checks for
+# duplicate inventory names) happens exactly as if every item was rendered.
+###############################################################################
+class MemoizedItems(object):
+    # An iterator over the items which need rendering, which records (in
+    # order) the memoized result or digest of every item it reads so that the
+    # rendered results can be matched back up with their position
+    def __init__(self, args, items, old_memo, new_memo):
+        self._items = iter(items)
+        self._templates_key = get_templates_key(args)
+        self._old_memo = old_memo
+        self.new_memo = new_memo
+        self.pending = collections.deque()
+        self.debug = args.debug
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        for item in self._items:
+            digest = get_item_digest(self._templates_key, *item)
+            result = self._old_memo.get(digest)
+            if result is not None:
+                self.debug and print("Reusing memoized result for %s item named %s" % (item[0], item[1]), file=sys.stderr)
+                self.new_memo[digest] = result
+                self.pending.append((True, result))
+                continue
+            self.pending.append((False, digest))
+            return item
+        raise StopIteration
+
+def iter_memoized_item_results(item_results, memoized_items):
+    pending = memoized_items.pending
+    for result in item_results:
+        # each rendered result belongs to the earliest item still waiting
+        # for one; memoized results queued before it are passed on first
+        while pending[0][0]:
+            yield pending.popleft()[1]
+        (_, digest) = pending.popleft()
+        memoized_items.new_memo[digest] = result
+        yield result
+    while pending:
+        yield pending.popleft()[1]
+
+def get_item_digest(templates_key, item_type, item_name, item_dict):
+    digest = hashlib.sha256()
+    digest.update(("%s\0%s\0%s\0" % (templates_key, item_type, item_name)).encode())
+    digest.update(json.dumps(item_dict, sort_keys=True, separators=(',', ':')).encode())
+    return digest.hexdigest()
+
+def get_render_memo_path(args):
+    state_path = os.path.abspath(args.terraform_state.name)
+    return os.path.join(args.cache_dir, "memo-%s.json" % (hashlib.sha256(state_path.encode()).hexdigest()[:16]))
+
+def iter_tfstate_items(tf_state, debug_p=False):
     for module in tf_state['modules']:
-        args.debug and print("Processing module path %s" % (module['path']), file=sys.stderr)
+        debug_p and print("Processing module path %s" % (module['path']), file=sys.stderr)
         outputs = module['outputs']
         for output_name in outputs:
-            output = Output(output_name, outputs[item_name])
-            (output_groups, output_hosts) = process_item_with_templates(item=output, item_type="output", item_name=output_name, filter_template=args.ansible_output_filter_template, inventory_name_template=args.ansible_output_inventory_name_template, groups_template=args.ansible_output_groups_template, host_vars_template=args.ansible_output_host_vars_template, debug_p=args.debug)
-        path = module['path']
-        depends_on = module['depends_on']
+            yield ("output", output_name, outputs[output_name])
         resources = module['resources']
         for resource_name in resources:
-            resource = Resource(resource_name, resources[item_name])
-            (resource_groups, resource_hosts) = process_item_with_templates(item=resource, item_type="resource", item_name=resource_name, filter_template=args.ansible_resource_filter_template, inventory_name_template=args.ansible_inventory_name_template, groups_template=args.ansible_groups_template, host_vars_template=args.ansible_host_vars_template, debug_p=args.debug)
-
-    # merge groups and hosts from outputs and resources
-    tfstate_data['groups'] = merge_groups(output_groups, resource_groups)
-    tfstate_data['hosts'] = merge_hosts(output_hosts, resource_hosts)
-    return tfstate_data
+            yield ("resource", resource_name, resources[resource_name])
 
 def process_item_with_templates(item, item_type, item_name, filter_template, inventory_name_template, groups_template, host_vars_template, debug_p=False):
     debug_p and print("Processing %s item named %s" % (item_type, item_name), file=sys.stderr)
-    host_vars = {}
-    groups = {}
-    hosts = {}
+    timings = _timings
+    timings and timings.start()
     try:
         filter_value = filter_template.render(item)
     except jinja_exc.UndefinedError as e:
         sys.exit("Error rendering filter template: %s (template was '%s')" % (e, filter_template.source()))
-    if filter_value == "False":
-        continue
-    elif filter_value != "True":
-        raise ValueError("Unexpected value returned from filter_template: %s (template was [%s])" % (filter_value, filter_template.source()))
+    timings and timings.stop('render_filter')
+    if not check_filter_value(filter_value, filter_template, item_type):
+        return ({}, {})
+    timings and timings.start()
     try:
         inventory_name = inventory_name_template.render(item)
     except jinja_exc.UndefinedError as e:
         sys.exit("Error rendering inventory name template: %s (template was '%s')" % (e, inventory_name_template.source()))
+    timings and timings.stop('render_inventory_name')
     debug_p and print("Rendered ansible_inventory_name_template as '%s' for %s" % (inventory_name, item_name), file=sys.stderr)
+    timings and timings.start()
     try:
-        group_names = re.split('\s*\n\s*', groups_template.render(resource))
+        group_names = re.split(r'\s*\n\s*', groups_template.render(item))
     except jinja_exc.UndefinedError as e:
         sys.exit("Error rendering groups template: %s (template was '%s')" % (e, groups_template.source()))
+    timings and timings.stop('render_groups')
     debug_p and print("Rendered ansible_groups_template as '%s' for %s" % (group_names, item_name), file=sys.stderr)
+    timings and timings.start()
+    host_var_items = render_host_var_items(item, item_name, host_vars_template, debug_p)
+    timings and timings.stop('render_host_vars')
+    return make_item_groups_and_hosts(item_name, inventory_name, group_names, host_var_items, debug_p)
+
+def process_item_with_combined_template(item, item_type, item_name, combined_template, filter_template, inventory_name_template, groups_template, host_vars_template, debug_p=False):
+    debug_p and print("Processing %s item named %s with combined template" % (item_type, item_name), file=sys.stderr)
+    timings = _timings
+    parts = combined_template.generated_parts
+    if parts is not None and 'filter' not in parts:
+        # the filter is native, so excluded items are not rendered at all
+        timings and timings.start()
+        filter_value = filter_template.render(item)
+        timings and timings.stop('render_filter')
+        if not check_filter_value(filter_value, filter_template, item_type):
+            return ({}, {})
+    timings and timings.start()
+    try:
+        result = combined_template.render_result(item)
+    except Exception as e:
+        timings and timings.stop('render_combined')
+        if parts is None:
+            if isinstance(e, (jinja_exc.UndefinedError, ValueError)):
+                sys.exit("Error rendering combined template: %s (template was '%s')" % (e, combined_template.source()))
+            raise
+        # render the templates separately, so that the error is reported
+        # against the template which caused it
+        debug_p and print("Rendering combined template failed for %s, rendering templates separately: %s" % (item_name, e), file=sys.stderr)
+        return process_item_with_templates(item, item_type, item_name, filter_template, inventory_name_template, groups_template, host_vars_template, debug_p=debug_p)
+    timings and timings.stop('render_combined')
+
+    if parts is None:
+        if result.inventory_name is None:
+            timings and timings.count("%ss_filtered" % (item_type))
+            return ({}, {})
+        timings and timings.count("%ss_accepted" % (item_type))
+        debug_p and print("Rendered combined template as name '%s', groups '%s', host_vars '%s' for %s" % (result.inventory_name, result.group_names, result.host_var_items, item_name), file=sys.stderr)
+        return make_item_groups_and_hosts(item_name, result.inventory_name, result.group_names or [], result.host_var_items or [], debug_p)
+
+    if 'filter' in parts and not check_filter_value(result.filter_value, filter_template, item_type):
+        return ({}, {})
+    if 'inventory_name' in parts:
+        inventory_name = result.inventory_name
+    else:
+        inventory_name = inventory_name_template.render(item)
+    if 'groups' in parts:
+        group_names = result.group_names
+    else:
+        group_names = re.split(r'\s*\n\s*', groups_template.render(item))
+    if 'host_vars' in parts:
+        host_var_items = parse_host_vars_text(result.host_vars_text, host_vars_template)
+    else:
+        host_var_items = render_host_var_items(item, item_name, host_vars_template, debug_p)
+    debug_p and print("Rendered combined template as name '%s', groups '%s' for %s" % (inventory_name, group_names, item_name), file=sys.stderr)
+    return make_item_groups_and_hosts(item_name, inventory_name, group_names, host_var_items, debug_p)
+
+def check_filter_value(filter_value, filter_template, item_type):
+    if filter_value == "False":
+        _timings and _timings.count("%ss_filtered" % (item_type))
+        return False
+    elif filter_value != "True":
+        raise ValueError("Unexpected value returned from filter_template: %s (template was [%s])" % (filter_value, filter_template.source()))
+    _timings and _timings.count("%ss_accepted" % (item_type))
+    return True
+
+def render_host_var_items(item, item_name, host_vars_template, debug_p=False):
+    host_var_items = None
+    if isinstance(host_vars_template, NativeTemplate):
+        host_var_items = host_vars_template.render_host_vars(item)
+        debug_p and host_var_items is not None and print("Rendered ansible_host_vars_template natively as '%s' for %s" % (host_var_items, item_name), file=sys.stderr)
+    if host_var_items is None:
+        try:
+            host_vars_text = host_vars_template.render(item)
+        except jinja_exc.UndefinedError as e:
+            sys.exit("Error rendering host_vars template: %s (template was '%s')" % (e, host_vars_template.source()))
+        debug_p and print("Rendered ansible_host_vars_template as '%s' for %s" % (host_vars_text, item_name), file=sys.stderr)
+        host_var_items = parse_host_vars_text(host_vars_text, host_vars_template)
+    return host_var_items
+
+def make_item_groups_and_hosts(item_name, inventory_name, group_names, host_var_items, debug_p=False):
+    host_vars = {}
+    groups = {}
+    hosts = {}
     for group_name in group_names:
         if group_name not in groups:
             groups[group_name] = {}
             groups[group_name]['hosts'] = []
         debug_p and print("'%s' added to group '%s' for %s" % (inventory_name, group_name, item_name), file=sys.stderr)
         groups[group_name]['hosts'].append(inventory_name)
+    for (key, value) in host_var_items:
+        host_vars[key] = value
+        debug_p and print("host_var '%s' set to '%s' for %s" % (key, value, item_name), file=sys.stderr)
+    if inventory_name not in hosts:
+        hosts[inventory_name] = host_vars
+    else:
+        sys.exit("inventory_name was not unique across terraform resources: '%s' was a duplicate" % (inventory_name))
+    return (groups, hosts)
+
+def parse_host_vars_text(host_vars_text, host_vars_template):
+    if isinstance(host_vars_template, JsonHostVarsTemplate):
+        return parse_host_vars_json(host_vars_text, host_vars_template)
+    return parse_host_var_key_values(re.split(r'\s*\n\s*', host_vars_text), host_vars_template)
+
+def parse_host_vars_json(host_vars_text, host_vars_template):
+    if host_vars_text.strip() == "":
+        return []
     try:
-        host_var_key_values = re.split('\s*\n\s*', host_vars_template.render(resource))
-    except jinja_exc.UndefinedError as e:
-        sys.exit("Error rendering host_vars template: %s (template was '%s')" % (e, host_vars_template.source()))
-    debug_p and print("Rendered ansible_host_vars_template as '%s' for %s" % (host_var_key_values, item_name), file=sys.stderr)
+        host_vars = json.loads(host_vars_text)
+    except ValueError as e:
+        sys.exit("Error parsing JSON rendered from host_vars template: %s (template was '%s')" % (e, host_vars_template.source()))
+    if not isinstance(host_vars, dict):
+        sys.exit("host_vars template did not render a JSON object: '%s' (template was '%s')" % (host_vars_text, host_vars_template.source()))
+    return list(host_vars.items())
+
+def parse_host_var_key_values(host_var_key_values, host_vars_template):
+    host_var_items = []
     for key_value in host_var_key_values:
         key_value = key_value.strip()
         if key_value == "":
@@ -223,45 +747,60 @@ def process_item_with_templates(item, item_type, item_name, filter_template, inv
             print("WARNING: no '=' in assignment '%s' rendered from ansible_host_vars_template [%s]" % (key_value, host_vars_template.source()), file=sys.stderr)
             value = ""
         else:
-            value = key_value[1].strip()
-            if value.startswith('['):
-                value = ast.literal_eval(value)
-            elif value.startswith('{'):
-                value = ast.literal_eval(value)
-        host_vars[key] = value
-        debug_p and print("host_var '%s' set to '%s' for %s" % (key, value, item_name), file=sys.stderr)
-    if inventory_name not in hosts:
-        hosts[inventory_name] = host_vars
-    else:
-        sys.exit("inventory_name was not unique across terraform resources: '%s' was a duplicate" % (inventory_name))
-    return (groups, hosts)
+            try:
+                value = parse_host_var_value(key_value[1])
+            except (ValueError, SyntaxError) as e:
+                sys.exit("Error parsing value of host_var '%s' rendered from host_vars template: %s (template was '%s')" % (key, e, host_vars_template.source()))
+        host_var_items.append((key, value))
+    return host_var_items
+
+def parse_host_var_value(value):
+    # raises ValueError (or SyntaxError) for a list or dict which is not a
+    # python literal, or whose value cannot be output as JSON (e.g. a set), so
+    # that the error is reported while processing rather than part way
+    # through writing the output
+    value = value.strip()
+    if value.startswith(('[', '{')):
+        import ast
+        value = ast.literal_eval(value)
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError) as e:
+            raise ValueError("%r cannot be output as JSON: %s" % (value, e))
+    return value
 
 def merge_hosts(*hosts_list):
     hosts = {}
     for hosts_to_merge in hosts_list:
-        for inventory_name in hosts_to_merge.keys():
-            if inventory_name not in hosts:
-                hosts[inventory_name] = hosts_to_merge[inventory_name]
-            else:
-                sys.exit("inventory_name was not unique across terraform resources & outputs: '%s' was a duplicate" % (inventory_name))
+        merge_hosts_into(hosts, hosts_to_merge)
     return hosts
 
+def merge_hosts_into(hosts, hosts_to_merge):
+    for inventory_name in hosts_to_merge.keys():
+        if inventory_name not in hosts:
+            hosts[inventory_name] = hosts_to_merge[inventory_name]
+        else:
+            sys.exit("inventory_name was not unique across terraform resources & outputs: '%s' was a duplicate" % (inventory_name))
+
 def merge_groups(*groups_list):
     groups = {}
     for groups_to_merge in groups_list:
-        for group_name in groups_to_merge.keys():
-            group = groups_to_merge[group_name]
-            for group_key in group.keys():
-                if group_key == 'hosts':
-                    hosts_list = group[group_key]
-                    if group_name not in groups:
-                        groups[group_name] = {}
-                        groups[group_name]['hosts'] = []
-                    groups[group_name]['hosts'].extend(hosts_list)
-                else:
-                    sys.exit("don't know how to merge group key: %s" % (group_key))
+        merge_groups_into(groups, groups_to_merge)
     return groups
 
+def merge_groups_into(groups, groups_to_merge):
+    for group_name in groups_to_merge.keys():
+        group = groups_to_merge[group_name]
+        for group_key in group.keys():
+            if group_key == 'hosts':
+                hosts_list = group[group_key]
+                if group_name not in groups:
+                    groups[group_name] = {}
+                    groups[group_name]['hosts'] = []
+                groups[group_name]['hosts'].extend(hosts_list)
+            else:
+                sys.exit("don't know how to merge group key: %s" % (group_key))
+
 def list_groups(tf_state_data):
     meta = {"hostvars": tf_state_data['hosts']}
     list_with_meta = tf_state_data['groups']
@@ -271,107 +810,1075 @@ def list_groups(tf_state_data):
 def get_host(tf_state_data, inventory_name):
     return tf_state_data['hosts'].get(inventory_name, {})
 
+###############################################################################
+# Streaming tfstate reader:
+# rather than loading the whole state with `json.load`, the top-level object
+# and the `modules` array are walked incrementally and each entry of a
+# module's `resources` and `outputs` is decoded on its own, so that only one
+# raw resource needs to be held in memory at a time. Items are yielded in the
+# order in which they appear in the file, which is the same as that of
+# iter_tfstate_items for states written by terraform (which writes each
+# module's `outputs` before its `resources`).
+###############################################################################
+STREAM_CHUNK_SIZE = 1 << 16
+
+class JsonStream(object):
+    def __init__(self, f, chunk_size=STREAM_CHUNK_SIZE):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._buf = ''
+        self._pos = 0
+        # number of characters read before the start of the buffer
+        self._offset = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+        self.ascii = True
+
+    def _fill(self, size=None):
+        if self._eof:
+            return False
+        chunk = self._f.read(size or self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        if self.ascii and not chunk.isascii():
+            self.ascii = False
+        self._offset += self._pos
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def position(self):
+        # the offset in characters from the start of the file of the next
+        # value (or of the whitespace before it)
+        return self._offset + self._pos
+
+    def peek(self):
+        while True:
+            buf = self._buf
+            pos = self._pos
+            while pos < len(buf) and buf[pos] in ' \t\n\r':
+                pos += 1
+            self._pos = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not self._fill():
+                return None
+
+    def expect(self, ch):
+        found = self.peek()
+        if found != ch:
+            raise ValueError("Error parsing terraform state JSON: expected '%s' but found '%s'" % (ch, found))
+        self._pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                (value, end) = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # the value may continue beyond the end of the buffer: read
+                # more (doubling each time so large values are not rescanned
+                # once per chunk) and try again
+                if not self._fill(max(self._chunk_size, len(self._buf))):
+                    raise
+                continue
+            if end == len(self._buf) and self._fill():
+                # a number (or other scalar) may have been cut off at the end of the buffer
+                continue
+            self._pos = end
+            return value
+
+    def object_keys(self):
+        # yields each key of an object in turn; the caller must consume the
+        # corresponding value (with `value` or by iterating into it) before
+        # asking for the next key
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self._pos += 1
+            else:
+                self.expect('}')
+                return
+
+    def array_items(self):
+        # yields once for each element of an array; the caller must consume
+        # the element before asking for the next one
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield
+            if self.peek() == ',':
+                self._pos += 1
+            else:
+                self.expect(']')
+                return
+
+def stream_tfstate_items(tf_state_file, debug_p=False, host_index=None):
+    stream = JsonStream(tf_state_file)
+    for item in iter_stream_tfstate_items(stream, debug_p, host_index):
+        yield item
+    if host_index is not None:
+        # character offsets are byte offsets if every character was a single
+        # byte and no '\r\n' newlines were translated
+        host_index.seekable = stream.ascii and getattr(tf_state_file, 'newlines', None) in (None, '\n')
+
+def iter_stream_tfstate_items(stream, debug_p=False, host_index=None):
+    for key in stream.object_keys():
+        if key != 'modules':
+            stream.value()
+            continue
+        for _ in stream.array_items():
+            for module_key in stream.object_keys():
+                if module_key == 'path':
+                    path = stream.value()
+                    debug_p and print("Processing module path %s" % (path), file=sys.stderr)
+                elif module_key in ('outputs', 'resources'):
+                    item_type = module_key[:-1]
+                    for item_name in stream.object_keys():
+                        if host_index is None:
+                            yield (item_type, item_name, stream.value())
+                            continue
+                        stream.peek()
+                        start = stream.position()
+                        item_dict = stream.value()
+                        host_index.add_item(item_type, item_name, start, stream.position())
+                        yield (item_type, item_name, item_dict)
+                else:
+                    stream.value()
+
+def get_tfstate_data(args):
+    cache_path = None
+    if not args.no_cache:
+        cache_path = get_cache_path(args)
+        if cache_path is None:
+            args.debug and print("Not caching: %s is not a regular file" % (args.terraform_state.name), file=sys.stderr)
+    if cache_path is None:
+        return process_tfstate_stream(args, args.terraform_state)
+
+    if args.invalidate_cache:
+        args.debug and print("Invalidating cache entry %s" % (cache_path), file=sys.stderr)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(cache_path)
+    else:
+        tf_state_data = load_cached_tfstate_data(cache_path, args.cache_ttl)
+        if tf_state_data is not None:
+            args.debug and print("Using cached tf_state data from %s" % (cache_path), file=sys.stderr)
+            _timings and _timings.count('cache_hits')
+            return tf_state_data
+
+    with cache_lock(get_cache_lock_path(args)):
+        # another invocation may have populated the cache while we waited for the lock
+        tf_state_data = None
+        if not args.invalidate_cache:
+            tf_state_data = load_cached_tfstate_data(cache_path, args.cache_ttl)
+        if tf_state_data is None:
+            host_index = HostIndex()
+            tf_state_data = process_tfstate_stream(args, args.terraform_state, host_index=host_index)
+            args.debug and print("Storing tf_state data in cache %s" % (cache_path), file=sys.stderr)
+            store_cached_tfstate_data(cache_path, tf_state_data, args.cache_ttl)
+            store_cached_tfstate_data(get_host_index_path(cache_path), host_index.as_dict(), args.cache_ttl)
+    return tf_state_data
+
+def get_cache_path(args):
+    try:
+        state_stat = os.fstat(args.terraform_state.fileno())
+    except (AttributeError, OSError):
+        return None
+    if not stat.S_ISREG(state_stat.st_mode):
+        return None
+    key = hashlib.sha256()
+    key.update(("yatadis-cache-v%d\0" % (CACHE_FORMAT_VERSION)).encode())
+    key.update(("%s\0%d\0%d\0" % (os.path.abspath(args.terraform_state.name), state_stat.st_size, state_stat.st_mtime_ns)).encode())
+    content_hash = hashlib.sha256()
+    for chunk in iter(lambda: args.terraform_state.read(STREAM_CHUNK_SIZE), ''):
+        content_hash.update(chunk.encode())
+    args.terraform_state.seek(0)
+    key.update(content_hash.digest())
+    key.update(get_templates_key(args).encode())
+    return os.path.join(args.cache_dir, "%s.json" % (key.hexdigest()))
+
+def get_templates_key(args):
+    # the key of the templates as they were given, so it is computed (and
+    # kept in args) before prepare_templates replaces any of them, which lets
+    # the daemon be queried without compiling any template
+    templates_key = getattr(args, 'templates_key', None)
+    if templates_key is None:
+        templates_key = args.templates_key = make_templates_key(args)
+    return templates_key
+
+def make_templates_key(args):
+    key = hashlib.sha256()
+    key.update(("yatadis-templates-v%d\0" % (CACHE_FORMAT_VERSION)).encode())
+    for template_arg in TEMPLATE_ARGS:
+        key.update(getattr(args, template_arg).source().encode())
+        key.update(b"\0")
+    for template_arg in COMBINED_TEMPLATE_ARGS:
+        template = getattr(args, template_arg)
+        if template is not None:
+            key.update(("%s=%s\0" % (template_arg, template.source())).encode())
+    for format_arg in HOST_VARS_FORMAT_ARGS.values():
+        host_vars_format = getattr(args, format_arg)
+        if host_vars_format != 'text':
+            key.update(("%s=%s\0" % (format_arg, host_vars_format)).encode())
+    return key.hexdigest()
+
+def load_cached_tfstate_data(cache_path, ttl):
+    try:
+        with open(cache_path, 'r') as f:
+            if ttl is not None and time.time() - os.fstat(f.fileno()).st_mtime > ttl:
+                return None
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def store_cached_tfstate_data(cache_path, tf_state_data, ttl):
+    cache_dir = os.path.dirname(cache_path)
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        # write to a temporary file and atomically rename it into place so
+        # that concurrent readers never see a partially written entry
+        import tempfile
+        with tempfile.NamedTemporaryFile('w', dir=cache_dir, prefix='.tmp-', suffix='.json', delete=False) as f:
+            # json.dumps uses the C encoder, which json.dump to a file does not
+            f.write(json.dumps(tf_state_data))
+        os.replace(f.name, cache_path)
+    except OSError as e:
+        print("WARNING: could not write inventory cache %s: %s" % (cache_path, e), file=sys.stderr)
+        return
+    prune_cache_dir(cache_dir, ttl)
+
+def prune_cache_dir(cache_dir, ttl):
+    now = time.time()
+    # removes cache entries and template bytecode (which is touched whenever
+    # it is loaded) older than the TTL. Lock files and render memos (one of
+    # each per state) are never removed: a lock file may be held by another
+    # invocation, and a memo never expires.
+    for entry in os.scandir(cache_dir):
+        if entry.name.startswith(('.', 'memo-')):
+            continue
+        if not entry.name.endswith('.json') and not fnmatch.fnmatch(entry.name, TEMPLATE_BYTECODE_CACHE_PATTERN % ('*')):
+            continue
+        with contextlib.suppress(OSError):
+            if now - entry.stat().st_mtime > ttl:
+                os.remove(entry.path)
+
+def get_cache_lock_path(args):
+    # one lock per state path rather than per cache key (which changes along
+    # with the state), so that lock files do not accumulate
+    state_path = os.path.abspath(args.terraform_state.name)
+    return os.path.join(args.cache_dir, "lock-%s.lock" % (hashlib.sha256(state_path.encode()).hexdigest()[:16]))
+
+@contextlib.contextmanager
+def cache_lock(lock_path):
+    if fcntl is None:
+        yield
+        return
+    try:
+        os.makedirs(os.path.dirname(lock_path), mode=0o700, exist_ok=True)
+        lock_file = open(lock_path, 'a')
+    except OSError:
+        yield
+        return
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+###############################################################################
+# Host index:
+# whenever the inventory of a state is cached, an index is cached alongside
+# it which maps each inventory_name to the resource or output which produced
+# it and to where that item is in the state file. `--host` then reads, renders
+# and expands only that one item rather than processing the entire state.
+# Without the cache, if the inventory names are the default `{{ name }}`,
+# only items with the requested name are rendered.
+###############################################################################
+class HostIndex(object):
+    def __init__(self):
+        # (item_type, item_name, start, end) of each item streamed but whose
+        # result has not yet been added
+        self.pending = collections.deque()
+        self.hosts = {}
+        self.seekable = False
+
+    def add_item(self, item_type, item_name, start, end):
+        self.pending.append([item_type, item_name, start, end])
+
+    def add_result(self, item_hosts):
+        # results are added in the same order as the items were streamed
+        location = self.pending.popleft()
+        for inventory_name in item_hosts:
+            self.hosts[inventory_name] = location
+
+    def as_dict(self):
+        return {'seekable': self.seekable, 'hosts': self.hosts}
+
+def get_host_index_path(cache_path):
+    return re.sub(r'\.json\Z', '.index.json', cache_path)
+
+def lookup_host(args):
+    # returns the host vars of args.host without processing the entire state,
+    # or None if that is not possible
+    with open_tfstate(args) as state_args:
+        if state_args.terraform_state is None:
+            return None
+        if not state_args.no_cache:
+            cache_path = get_cache_path(state_args)
+            if cache_path is not None:
+                return get_indexed_host(state_args, cache_path)
+        return get_named_host(state_args)
+
+def get_indexed_host(args, cache_path):
+    if args.invalidate_cache:
+        return None
+    host_index = load_cached_tfstate_data(get_host_index_path(cache_path), args.cache_ttl)
+    if host_index is None:
+        return None
+    location = host_index['hosts'].get(args.host)
+    if location is None:
+        args.debug and print("Host %s is not in the host index" % (args.host), file=sys.stderr)
+        return get_host({'hosts': {}}, args.host)
+    (item_type, item_name, start, end) = location
+    args.debug and print("Host %s is %s %s at [%d:%d] in the host index" % (args.host, item_type, item_name, start, end), file=sys.stderr)
+    try:
+        item_dict = json.loads(read_state_range(args.terraform_state, start, end, host_index['seekable']))
+    except (OSError, ValueError) as e:
+        args.debug and print("Could not read %s %s from %s: %s" % (item_type, item_name, args.terraform_state.name, e), file=sys.stderr)
+        return None
+    _timings and _timings.count('host_index_hits')
+    (_, item_hosts) = process_tfstate_item(args, item_type, item_name, item_dict)
+    if args.host not in item_hosts:
+        return None
+    return get_host({'hosts': item_hosts}, args.host)
+
+def read_state_range(tf_state_file, start, end, seekable):
+    if seekable:
+        with open(tf_state_file.name, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start).decode('ascii')
+    # character offsets into a text file can only be reached by reading up
+    # to them
+    tf_state_file.seek(0)
+    try:
+        remaining = start
+        while remaining > 0:
+            chunk = tf_state_file.read(min(STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+        return tf_state_file.read(end - start)
+    finally:
+        tf_state_file.seek(0)
+
+def get_named_host(args):
+    if not isinstance(args.ansible_inventory_name_template, NativeNameTemplate) or not isinstance(args.ansible_output_inventory_name_template, NativeNameTemplate):
+        return None
+    if args.resource_combined_template is not None and args.resource_combined_template.generated_parts is None:
+        return None
+    if args.output_combined_template is not None and args.output_combined_template.generated_parts is None:
+        return None
+    args.debug and print("Rendering only the items named %s" % (args.host), file=sys.stderr)
+    hosts = {}
+    for (item_type, item_name, item_dict) in stream_tfstate_items(args.terraform_state, debug_p=args.debug):
+        if item_name == args.host:
+            merge_hosts_into(hosts, process_tfstate_item(args, item_type, item_name, item_dict)[1])
+    return get_host({'hosts': hosts}, args.host)
+
+###############################################################################
+# Multiple states:
+# `--state` (or TF_STATE) may name several states, separated by the path
+# separator (':' on unix) or given by repeating `--state`, each of which may
+# be a path, a glob or a directory (searched recursively for *.tfstate
+# files). The templates are compiled once, each state is processed (and
+# cached) on its own as if it had been the only one, and their groups and
+# hosts are then merged, with any inventory_name which more than one state
+# produces reported along with the states it came from. With more than one
+# worker (`--ansible-workers`), the states are processed in parallel, each
+# worker processing whole states.
+###############################################################################
+STATE_FILE_PATTERN = '*.tfstate'
+
+def get_state_paths(state_specs):
+    state_paths = []
+    for state_spec in state_specs:
+        for spec in state_spec.split(os.pathsep):
+            if spec == "":
+                continue
+            if os.path.isdir(spec):
+                matches = sorted(glob.glob(os.path.join(spec, '**', STATE_FILE_PATTERN), recursive=True))
+                if not matches:
+                    raise ValueError("no %s files found in directory '%s'" % (STATE_FILE_PATTERN, spec))
+                state_paths.extend(matches)
+            elif re.search(r"[*?[]", spec):
+                matches = sorted(path for path in glob.glob(spec, recursive=True) if not os.path.isdir(path))
+                if not matches:
+                    raise ValueError("no files match '%s'" % (spec))
+                state_paths.extend(matches)
+            else:
+                state_paths.append(spec)
+    if not state_paths:
+        raise ValueError("no terraform state specified")
+    # a state matched by more than one spec is only processed once
+    return list(collections.OrderedDict.fromkeys(state_paths))
+
+def get_state_key(args):
+    return os.pathsep.join(os.path.abspath(state_path) for state_path in args.terraform_state_paths)
+
+@contextlib.contextmanager
+def open_tfstate(args):
+    # yields a copy of args in which terraform_state is the state file, opened
+    # afresh so that a state which has been replaced since it was last read
+    # is read anew, or None if there are several states (each of which is
+    # opened as it is processed)
+    state_args = argparse.Namespace(**vars(args))
+    state_args.terraform_state = None
+    if len(args.terraform_state_paths) != 1:
+        yield state_args
+        return
+    state_path = args.terraform_state_paths[0]
+    if state_path == '-':
+        state_args.terraform_state = sys.stdin
+        yield state_args
+        return
+    try:
+        tf_state_file = open(state_path, 'r')
+    except OSError as e:
+        sys.exit("could not read terraform state %s: %s" % (state_path, e))
+    with tf_state_file:
+        state_args.terraform_state = tf_state_file
+        yield state_args
+
+def get_inventory_data(args):
+    with open_tfstate(args) as state_args:
+        if state_args.terraform_state is not None:
+            return get_tfstate_data(state_args)
+        return get_multi_tfstate_data(state_args)
+
+def get_multi_tfstate_data(args):
+    state_paths = args.terraform_state_paths
+    if args.workers != 1:
+        state_results = iter_parallel_state_results(args, state_paths)
+    else:
+        state_results = (process_tfstate_path(args, state_path) for state_path in state_paths)
+    groups = {}
+    hosts = {}
+    host_state_paths = {}
+    for (state_path, tf_state_data) in zip(state_paths, state_results):
+        timings = _timings
+        timings and timings.start()
+        for inventory_name in tf_state_data['hosts']:
+            if inventory_name in host_state_paths:
+                sys.exit("inventory_name was not unique across terraform states: '%s' was in both %s and %s" % (inventory_name, host_state_paths[inventory_name], state_path))
+            host_state_paths[inventory_name] = state_path
+        merge_groups_into(groups, tf_state_data['groups'])
+        merge_hosts_into(hosts, tf_state_data['hosts'])
+        timings and timings.stop('merge')
+    return {'groups': groups, 'hosts': hosts}
+
+def process_tfstate_path(args, state_path):
+    args.debug and print("Processing terraform state %s" % (state_path), file=sys.stderr)
+    state_args = argparse.Namespace(**vars(args))
+    state_args.terraform_state_paths = [state_path]
+    try:
+        with open(state_path, 'r') as f:
+            state_args.terraform_state = f
+            return get_tfstate_data(state_args)
+    except OSError as e:
+        sys.exit("could not read terraform state %s: %s" % (state_path, e))
+    except SystemExit as e:
+        if isinstance(e.code, str):
+            sys.exit("%s: %s" % (state_path, e.code))
+        raise
+
+def iter_parallel_state_results(args, state_paths):
+    workers = min(get_parallel_workers(args), len(state_paths))
+    args.debug and print("Processing %d states in parallel using %d worker processes" % (len(state_paths), workers), file=sys.stderr)
+    with make_parallel_executor(args, workers) as executor:
+        futures = [executor.submit(process_tfstate_path_in_worker, state_path) for state_path in state_paths]
+        try:
+            for future in futures:
+                (tf_state_data, timings_data) = future.result()
+                if timings_data is not None:
+                    _timings.merge(timings_data)
+                yield tf_state_data
+        finally:
+            for future in futures:
+                future.cancel()
+
+def process_tfstate_path_in_worker(state_path):
+    timings = None
+    if _parallel_worker_timings_slowest is not None:
+        timings = enable_timings(slowest=_parallel_worker_timings_slowest)
+    return (process_tfstate_path(_parallel_worker_args, state_path), timings and timings.as_dict())
+
+###############################################################################
+# Output:
+# the `--list` JSON is written a group and a host at a time rather than
+# serialised into one string (which, for a large inventory, is as big as the
+# inventory itself), producing the same bytes as `json.dumps`.
+#
+# Output options are applied to the processed inventory as it is output, so
+# neither the inventory cache nor the daemon's key depends on them:
+# --ansible-exclude-host-vars drops host vars whose names match any of its
+# glob patterns, and --ansible-compact drops empty host vars (null, "", []
+# and {}) and moves each host var which has the same value on every host of
+# a group into the `vars` of that group in the `--list` JSON. A var is only
+# moved into one group of any host, so the value a host ends up with never
+# depends on ansible's precedence between its groups, and `--host` still
+# returns it among the host's own vars (with the same value). Ansible applies
+# the vars of the `all` group to every host, whether it is listed in `all` or
+# not, so vars are only moved into `all` if it lists every host.
+###############################################################################
+def get_output_key(args):
+    return json.dumps([args.compact, args.exclude_host_vars])
+
+def compile_host_var_exclusions(exclude_host_vars):
+    patterns = [pattern.strip() for pattern in (exclude_host_vars or '').split(',') if pattern.strip()]
+    if len(patterns) == 0:
+        return None
+    return re.compile('|'.join(fnmatch.translate(pattern) for pattern in patterns))
+
+def is_empty_host_var(value):
+    return value is None or (isinstance(value, (str, list, dict)) and len(value) == 0)
+
+def filter_host_vars(host_vars, compact_p, exclusions):
+    return {key: value for (key, value) in host_vars.items()
+            if not (compact_p and is_empty_host_var(value))
+            and not (exclusions is not None and exclusions.match(key))}
+
+def get_output_inventory(args, tf_state_data):
+    # the processed inventory with the host vars filtered by the output
+    # options (but not yet moved into groups), without modifying tf_state_data
+    exclusions = compile_host_var_exclusions(args.exclude_host_vars)
+    if not args.compact and exclusions is None:
+        return tf_state_data
+    hosts = {inventory_name: filter_host_vars(host_vars, args.compact, exclusions)
+             for (inventory_name, host_vars) in tf_state_data['hosts'].items()}
+    return {'groups': tf_state_data['groups'], 'hosts': hosts}
+
+def get_output_host(args, host_vars):
+    return filter_host_vars(host_vars, args.compact, compile_host_var_exclusions(args.exclude_host_vars))
+
+def get_output_list_data(args, tf_state_data):
+    # the {'groups': ..., 'hosts': ...} to output for `--list`
+    tf_state_data = get_output_inventory(args, tf_state_data)
+    if args.compact:
+        return move_group_vars(tf_state_data)
+    return tf_state_data
+
+def same_host_var(a, b):
+    # unlike ==, distinguishes e.g. 1, 1.0 and true (also inside containers)
+    if type(a) is not type(b) or a != b:
+        return False
+    if isinstance(a, (list, dict)):
+        # (equal containers with their keys in a different order differ here,
+        # which only means that the var is not moved)
+        return repr(a) == repr(b)
+    return True
+
+def move_group_vars(tf_state_data):
+    timings = _timings
+    timings and timings.start()
+    hosts = dict(tf_state_data['hosts'])
+    groups = {}
+    moved_keys = collections.defaultdict(set)
+    # the largest groups first, as moving their vars saves the most
+    for (group_name, group) in sorted(tf_state_data['groups'].items(), key=lambda item: -len(item[1]['hosts'])):
+        group_hosts = [inventory_name for inventory_name in group['hosts'] if inventory_name in hosts]
+        group_vars = {}
+        # (ansible applies the vars of `all` to every host, listed or not)
+        if len(group_hosts) > 1 and (group_name != 'all' or len(set(group_hosts)) == len(hosts)):
+            group_vars = dict(hosts[group_hosts[0]])
+            for inventory_name in group_hosts[1:]:
+                host_vars = hosts[inventory_name]
+                group_vars = {key: value for (key, value) in group_vars.items() if key in host_vars and same_host_var(host_vars[key], value)}
+                if len(group_vars) == 0:
+                    break
+            for inventory_name in group_hosts:
+                for key in moved_keys[inventory_name].intersection(group_vars):
+                    del group_vars[key]
+        if len(group_vars) > 0:
+            for inventory_name in group_hosts:
+                hosts[inventory_name] = {key: value for (key, value) in hosts[inventory_name].items() if key not in group_vars}
+                moved_keys[inventory_name].update(group_vars)
+            group = dict(group, vars=group_vars)
+        groups[group_name] = group
+    # keep the groups in their original order
+    groups = {group_name: groups[group_name] for group_name in tf_state_data['groups']}
+    timings and timings.stop('compact')
+    return {'groups': groups, 'hosts': hosts}
+
+def write_list_json(f, tf_state_data):
+    # writes the same JSON as `json.dumps(list_groups(tf_state_data))`
+    f.write("{")
+    separator = ""
+    for (group_name, group) in tf_state_data['groups'].items():
+        if group_name == '_meta':
+            # replaced by the _meta key of the hostvars, as in list_groups
+            continue
+        f.write("%s%s: %s" % (separator, json.dumps(group_name), json.dumps(group)))
+        separator = ", "
+    f.write('%s"_meta": {"hostvars": {' % (separator))
+    separator = ""
+    for (inventory_name, host_vars) in tf_state_data['hosts'].items():
+        f.write("%s%s: %s" % (separator, json.dumps(inventory_name), json.dumps(host_vars)))
+        separator = ", "
+    f.write("}}}\n")
+
+###############################################################################
+# Inventory daemon:
+# `yatadis serve` holds the processed inventory in memory and answers
+# `--list` / `--host` requests on a unix socket, rebuilding it in the
+# background whenever the state file changes. Each request carries the state
+# path and a key of the template sources, and the daemon only answers
+# requests for the state and templates it is serving; otherwise (or if no
+# daemon is running) the client processes the state in-process.
+###############################################################################
+DEFAULT_DAEMON_POLL_INTERVAL = 2.0
+DAEMON_CLIENT_TIMEOUT = 10.0
+
+def get_daemon_socket_path(args):
+    if args.daemon_socket is not None:
+        return args.daemon_socket
+    return os.path.join(args.cache_dir, "daemon-%s.sock" % (hashlib.sha256(get_state_key(args).encode()).hexdigest()[:16]))
+
+def query_daemon(args):
+    socket_path = get_daemon_socket_path(args)
+    if not os.path.exists(socket_path):
+        return None
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    request = {
+        'state': get_state_key(args),
+        'templates': get_templates_key(args),
+        'output': get_output_key(args),
+        'host': args.host,
+    }
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(DAEMON_CLIENT_TIMEOUT)
+            sock.connect(socket_path)
+            with sock.makefile('rw') as f:
+                f.write(json.dumps(request) + "\n")
+                f.flush()
+                status = f.readline().rstrip("\n")
+                if status != "OK":
+                    args.debug and print("Inventory daemon at %s could not answer: %s" % (socket_path, status), file=sys.stderr)
+                    return None
+                ansible_json = f.readline().rstrip("\n")
+    except (OSError, ValueError) as e:
+        args.debug and print("Could not query inventory daemon at %s: %s" % (socket_path, e), file=sys.stderr)
+        return None
+    args.debug and print("Answered by inventory daemon at %s" % (socket_path), file=sys.stderr)
+    return ansible_json
+
+class InventoryDaemon(object):
+    def __init__(self, args, socket_path):
+        import threading
+        self.args = args
+        self.socket_path = socket_path
+        self.state_paths = [os.path.abspath(state_path) for state_path in args.terraform_state_paths]
+        self.state_key = get_state_key(args)
+        self.templates_key = get_templates_key(args)
+        self.output_key = get_output_key(args)
+        self.snapshot = None
+        self.state_fingerprint = None
+        self.changed = threading.Event()
+        self.stopped = threading.Event()
+
+    def get_state_fingerprint(self):
+        fingerprint = []
+        for state_path in self.state_paths:
+            try:
+                state_stat = os.stat(state_path)
+            except OSError:
+                fingerprint.append(None)
+                continue
+            fingerprint.append((state_stat.st_ino, state_stat.st_size, state_stat.st_mtime_ns))
+        return tuple(fingerprint)
+
+    def rebuild(self):
+        fingerprint = self.get_state_fingerprint()
+        # any error (including one raised by a template or by a malformed
+        # resource) leaves the last good snapshot in place, as the watcher
+        # thread must survive to pick up the next change to the state
+        try:
+            tf_state_data = get_inventory_data(self.args)
+            tf_state_data = get_output_inventory(self.args, tf_state_data)
+            list_data = move_group_vars(tf_state_data) if self.args.compact else tf_state_data
+            snapshot = {
+                'hosts': tf_state_data['hosts'],
+                'list_json': json.dumps(list_groups({'groups': dict(list_data['groups']), 'hosts': list_data['hosts']})),
+            }
+        except (Exception, SystemExit) as e:
+            print("ERROR: could not rebuild inventory from %s, still serving the last good inventory: %s: %s" % (", ".join(self.state_paths), type(e).__name__, e), file=sys.stderr)
+            if self.args.debug:
+                import traceback
+                traceback.print_exc(file=sys.stderr)
+            self.state_fingerprint = fingerprint
+            return False
+        # the snapshot is replaced with a single assignment so request
+        # handlers always see either the old or the new inventory in full
+        self.snapshot = snapshot
+        self.state_fingerprint = fingerprint
+        self.args.debug and print("Rebuilt inventory from %s" % (", ".join(self.state_paths)), file=sys.stderr)
+        return True
+
+    def watch(self):
+        while not self.stopped.is_set():
+            self.changed.wait(self.args.daemon_poll_interval)
+            self.changed.clear()
+            if self.stopped.is_set():
+                break
+            if self.get_state_fingerprint() != self.state_fingerprint:
+                self.rebuild()
+
+    def answer(self, request):
+        if request.get('state') != self.state_key:
+            return "MISMATCH state"
+        if request.get('templates') != self.templates_key:
+            return "MISMATCH templates"
+        if request.get('output') != self.output_key:
+            return "MISMATCH output"
+        if self.get_state_fingerprint() != self.state_fingerprint:
+            # wake the watcher to rebuild now rather than at the next poll
+            self.changed.set()
+        snapshot = self.snapshot
+        if request.get('host') is not None:
+            return "OK\n" + json.dumps(get_host(snapshot, request['host']))
+        return "OK\n" + snapshot['list_json']
+
+    def serve_forever(self):
+        if not self.rebuild():
+            sys.exit("could not build initial inventory from %s" % (", ".join(self.state_paths)))
+        remove_stale_daemon_socket(self.socket_path)
+        import socketserver
+        import threading
+        daemon = self
+
+        class InventoryRequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline())
+                    response = daemon.answer(request)
+                except (ValueError, AttributeError) as e:
+                    response = "ERROR %s" % (e)
+                self.wfile.write((response + "\n").encode())
+
+        old_umask = os.umask(0o077)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(self.socket_path, InventoryRequestHandler)
+        finally:
+            os.umask(old_umask)
+        server.daemon_threads = True
+        watcher = threading.Thread(target=self.watch, name="yatadis-watcher", daemon=True)
+        watcher.start()
+        print("Serving inventory for %s on %s" % (", ".join(self.state_paths), self.socket_path), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopped.set()
+            self.changed.set()
+            server.server_close()
+            with contextlib.suppress(OSError):
+                os.remove(self.socket_path)
+
+def remove_stale_daemon_socket(socket_path):
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), mode=0o700, exist_ok=True)
+    if not os.path.exists(socket_path):
+        return
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            os.remove(socket_path)
+            return
+    sys.exit("an inventory daemon is already listening on %s" % (socket_path))
+
+def serve(args):
+    import signal
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        sys.exit("serve requires unix domain socket support")
+    for state_path in args.terraform_state_paths:
+        if not os.path.isfile(state_path):
+            sys.exit("serve requires --state to be regular files, not '%s'" % (state_path))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    InventoryDaemon(args, get_daemon_socket_path(args)).serve_forever()
+
+###############################################################################
+# Library API:
+# an InventoryBuilder builds the inventory of one or more terraform states
+# in-process, for use as a library (e.g. by the ansible inventory plugin in
+# inventory_plugins/yatadis_inventory.py) rather than by running this script.
+# Options are keyword arguments named after the destinations of the command
+# line options (e.g. `ansible_groups_template`, `host_vars_format`,
+# `workers`), with templates given as their source, and any option which is
+# not given takes its default from the environment just as it does for the
+# script. The templates are compiled once, when the builder is created, and
+# the state is processed on the first call to list() (or to host(), unless it
+# is the first host asked for and can be looked up directly) and kept until
+# reload().
+###############################################################################
+class InventoryBuilder(object):
+    def __init__(self, state=None, args=None, **options):
+        # args is a Namespace of already parsed and prepared arguments, as
+        # passed by run(), in which case neither state nor options is used
+        if args is None:
+            args = make_argument_parser().parse_args([])
+            for (option, value) in options.items():
+                if option in ('command', 'list', 'host') or not hasattr(args, option):
+                    raise TypeError("InventoryBuilder got an unexpected option '%s'" % (option))
+                if (option in TEMPLATE_ARGS or option in COMBINED_TEMPLATE_ARGS) and value is not None:
+                    value = LazyTemplate(value if isinstance(value, str) else value.source())
+                setattr(args, option, value)
+            if state is not None:
+                args.terraform_state_specs = [state] if isinstance(state, str) else list(state)
+            resolve_state_paths(args)
+            prepare_templates(args)
+        self.args = args
+        self._tf_state_data = None
+        self._host_looked_up = False
+
+    def inventory(self):
+        # the processed {'groups': ..., 'hosts': ...} of the state(s)
+        if self._tf_state_data is None:
+            self._tf_state_data = get_inventory_data(self.args)
+        return self._tf_state_data
+
+    def list(self):
+        # the inventory in the form of ansible's `--list` JSON
+        tf_state_data = get_output_list_data(self.args, self.inventory())
+        return list_groups({'groups': dict(tf_state_data['groups']), 'hosts': tf_state_data['hosts']})
+
+    def write_list(self, f):
+        # writes the `--list` JSON to the file f
+        write_list_json(f, get_output_list_data(self.args, self.inventory()))
+
+    def host(self, inventory_name):
+        # the host vars of one host, in the form of ansible's `--host` JSON.
+        # Only the first host is looked up on its own, since each lookup
+        # reads (and hashes) the state: a caller asking for every host in
+        # turn gets the rest from the inventory instead.
+        if self._tf_state_data is None and not self._host_looked_up:
+            self._host_looked_up = True
+            args = argparse.Namespace(**vars(self.args))
+            args.host = inventory_name
+            host_vars = lookup_host(args)
+            if host_vars is not None:
+                return get_output_host(self.args, host_vars)
+        return get_output_host(self.args, get_host(self.inventory(), inventory_name))
+
+    def reload(self):
+        # discards the processed inventory, so that the state(s) are read
+        # again by the next call to list() or host()
+        self._tf_state_data = None
+        self._host_looked_up = False
+
+def resolve_state_paths(args):
+    state_specs = args.terraform_state_specs
+    if state_specs is None:
+        state_specs = [os.getenv('TF_STATE', 'terraform.tfstate')]
+    args.terraform_state_paths = get_state_paths(state_specs)
+
 def main():
+    parser = make_argument_parser()
+    args = parser.parse_args()
+    try:
+        resolve_state_paths(args)
+    except ValueError as e:
+        parser.error("argument --state: %s" % (e))
+
+    timings = None
+    if args.timings:
+        timings = enable_timings(slowest=args.timings_slowest)
+    profiler = None
+    if args.profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        run(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if timings is not None:
+            report_timings(args, timings)
+
+def make_argument_parser():
     parser = argparse.ArgumentParser(description='Terraform Ansible Inventory')
+    parser.add_argument('command', help="Run as a long-running daemon which serves the inventory to other invocations over a unix socket.", nargs='?', choices=['serve'], default=None)
     parser.add_argument('--list', help='List inventory', action='store_true', default=False)
     parser.add_argument('--host', help='Get hostvars for a specific host', default=None)
     parser.add_argument('--debug', help='Print additional debugging information to stderr', action='store_true', default=False)
-    parser.add_argument('--state', help="Location of Terraform .tfstate file (default: environment variable TF_STATE or 'terraform.tfstate' in the current directory)", type=argparse.FileType('r'), default=os.getenv('TF_STATE', 'terraform.tfstate'), dest='terraform_state')
-    parser.add_argument('--ansible-inventory-name-template', help="A jinja2 template used to generate the ansible `host` (i.e. the inventory name) from a terraform resource. (default: environment variable TF_ANSIBLE_INVENTORY_NAME_TEMPLATE or `%s`)" % (DEFAULT_ANSIBLE_INVENTORY_NAME_TEMPLATE), default=get_template_default('TF_ANSIBLE_INVENTORY_NAME_TEMPLATE', default=DEFAULT_ANSIBLE_INVENTORY_NAME_TEMPLATE), action=JinjaTemplateAction)
+    parser.add_argument('--timings', help='Report the wall and CPU time spent in each phase of processing, and counts of accepted and filtered resources, to stderr (or to the --timings-file). (default: environment variable TF_ANSIBLE_TIMINGS or False)', action='store_true', default=get_flag_default('TF_ANSIBLE_TIMINGS'))
+    parser.add_argument('--timings-file', help='Write the --timings report as JSON to this file rather than as text to stderr. (default: environment variable TF_ANSIBLE_TIMINGS_FILE)', default=os.getenv('TF_ANSIBLE_TIMINGS_FILE', None))
+    parser.add_argument('--timings-slowest', help='Include the N items which took longest to process in the --timings report. (default: environment variable TF_ANSIBLE_TIMINGS_SLOWEST or 0)', type=int, default=int(os.getenv('TF_ANSIBLE_TIMINGS_SLOWEST', 0)), metavar='N')
+    parser.add_argument('--profile', help='Write cProfile statistics for the run to this file. (default: environment variable TF_ANSIBLE_PROFILE)', default=os.getenv('TF_ANSIBLE_PROFILE', None))
+    parser.add_argument('--state', help="Location of Terraform .tfstate file, or of several states separated by '%s' (or by repeating --state), each of which may also be a glob or a directory to search for %s files. (default: environment variable TF_STATE or 'terraform.tfstate' in the current directory)" % (os.pathsep, STATE_FILE_PATTERN), action='append', default=None, dest='terraform_state_specs')
+    parser.add_argument('--ansible-inventory-name-template', help="A jinja2 template used to generate the ansible `host` (i.e. the inventory name) from a terraform resource. (default: environment variable TF_ANSIBLE_INVENTORY_NAME_TEMPLATE or `%s`)" % (DEFAULT_ANSIBLE_INVENTORY_NAME_TEMPLATE), default=get_template_default('TF_ANSIBLE_INVENTORY_NAME_TEMPLATE', default=DEFAULT_ANSIBLE_INVENTORY_NAME_TEMPLATE), type=LazyTemplate)
     parser.add_argument('--ansible-host-vars-template', help="A jinja2 template used to generate a newline separated list (with optional whitespace before or after the newline, which will be stripped\
-    ) of ansible host_vars settings (as '<key>=<value>' pairs) from a terraform resource. (default: environment variable TF_ANSIBLE_HOST_VARS_TEMPLATE or if not set, a template that maps all Terraform attributes to ansible host_vars prefixed by 'tf_' as well as setting 'ansible_host' to the IP address)", default=get_template_default('TF_ANSIBLE_HOST_VARS_TEMPLATE', default=DEFAULT_ANSIBLE_HOST_VARS_TEMPLATE), action=JinjaTemplateAction)
-    parser.add_argument('--ansible-groups-template', help="A jinja2 template used to generate a newline separated list (with optional whitespace before or after the newline, which will be stripped) of ansible `group` names to which the resource should belong. (default: environment variable TF_ANSIBLE_GROUPS_TEMPLATE or `%s`])" % (DEFAULT_ANSIBLE_GROUPS_TEMPLATE), default=get_template_default('TF_ANSIBLE_GROUPS_TEMPLATE', default=DEFAULT_ANSIBLE_GROUPS_TEMPLATE), action=JinjaTemplateAction)
-    parser.add_argument('--ansible-resource-filter-template', help="A jinja2 template used to filter terraform resources. This template is rendered for each resource and should evaluate to either the string 'True' to include the resource or 'False' to exclude it from the output.", default=get_template_default('TF_ANSIBLE_RESOURCE_FILTER_TEMPLATE', default=DEFAULT_ANSIBLE_RESOURCE_FILTER_TEMPLATE), action=JinjaTemplateAction)
-    parser.add_argument('--ansible-output-inventory-name-template', help="A jinja2 template used to generate the ansible `host` (i.e. the inventory name) from a terraform output. (default: environment variable TF_ANSIBLE_OUTPUT_INVENTORY_NAME_TEMPLATE or `%s`)" % (DEFAULT_ANSIBLE_OUTPUT_INVENTORY_NAME_TEMPLATE), default=get_template_default('TF_ANSIBLE_OUTPUT_INVENTORY_NAME_TEMPLATE', default=DEFAULT_ANSIBLE_OUTPUT_INVENTORY_NAME_TEMPLATE), action=JinjaTemplateAction)
+    ) of ansible host_vars settings (as '<key>=<value>' pairs) from a terraform resource. (default: environment variable TF_ANSIBLE_HOST_VARS_TEMPLATE or if not set, a template that maps all Terraform attributes to ansible host_vars prefixed by 'tf_' as well as setting 'ansible_host' to the IP address)", default=get_template_default('TF_ANSIBLE_HOST_VARS_TEMPLATE', default=DEFAULT_ANSIBLE_HOST_VARS_TEMPLATE), type=LazyTemplate)
+    parser.add_argument('--ansible-groups-template', help="A jinja2 template used to generate a newline separated list (with optional whitespace before or after the newline, which will be stripped) of ansible `group` names to which the resource should belong. (default: environment variable TF_ANSIBLE_GROUPS_TEMPLATE or `%s`])" % (DEFAULT_ANSIBLE_GROUPS_TEMPLATE), default=get_template_default('TF_ANSIBLE_GROUPS_TEMPLATE', default=DEFAULT_ANSIBLE_GROUPS_TEMPLATE), type=LazyTemplate)
+    parser.add_argument('--ansible-resource-filter-template', help="A jinja2 template used to filter terraform resources. This template is rendered for each resource and should evaluate to either the string 'True' to include the resource or 'False' to exclude it from the output.", default=get_template_default('TF_ANSIBLE_RESOURCE_FILTER_TEMPLATE', default=DEFAULT_ANSIBLE_RESOURCE_FILTER_TEMPLATE), type=LazyTemplate)
+    parser.add_argument('--ansible-output-inventory-name-template', help="A jinja2 template used to generate the ansible `host` (i.e. the inventory name) from a terraform output. (default: environment variable TF_ANSIBLE_OUTPUT_INVENTORY_NAME_TEMPLATE or `%s`)" % (DEFAULT_ANSIBLE_OUTPUT_INVENTORY_NAME_TEMPLATE), default=get_template_default('TF_ANSIBLE_OUTPUT_INVENTORY_NAME_TEMPLATE', default=DEFAULT_ANSIBLE_OUTPUT_INVENTORY_NAME_TEMPLATE), type=LazyTemplate)
     parser.add_argument('--ansible-output-host-vars-template', help="A jinja2 template used to generate a newline separated list (with optional whitespace before or after the newline, which will be stripped\
-    ) of ansible-output host_vars settings (as '<key>=<value>' pairs) from a terraform output. (default: environment variable TF_ANSIBLE_OUTPUT_HOST_VARS_TEMPLATE or if not set, a template that maps all Terraform attributes to ansible-output host_vars prefixed by 'tf_' as well as setting 'ansible-output_host' to the IP address)", default=get_template_default('TF_ANSIBLE_OUTPUT_HOST_VARS_TEMPLATE', default=DEFAULT_ANSIBLE_OUTPUT_HOST_VARS_TEMPLATE), action=JinjaTemplateAction)
-    parser.add_argument('--ansible-output-groups-template', help="A jinja2 template used to generate a newline separated list (with optional whitespace before or after the newline, which will be stripped) of ansible-output `group` names to which the output record should belong. (default: environment variable TF_ANSIBLE_OUTPUT_GROUPS_TEMPLATE or `%s`])" % (DEFAULT_ANSIBLE_OUTPUT_GROUPS_TEMPLATE), default=get_template_default('TF_ANSIBLE_OUTPUT_GROUPS_TEMPLATE', default=DEFAULT_ANSIBLE_OUTPUT_GROUPS_TEMPLATE), action=JinjaTemplateAction)
-    parser.add_argument('--ansible-output-filter-template', help="A jinja2 template used to filter terraform outputs. This template is rendered for each output and should evaluate to either the string 'True' to include the  or 'False' to exclude it from the output.", default=get_template_default('TF_ANSIBLE_OUTPUT_FILTER_TEMPLATE', default=DEFAULT_ANSIBLE_OUTPUT_FILTER_TEMPLATE), action=JinjaTemplateAction)
-    args = parser.parse_args()
+    ) of ansible-output host_vars settings (as '<key>=<value>' pairs) from a terraform output. (default: environment variable TF_ANSIBLE_OUTPUT_HOST_VARS_TEMPLATE or if not set, a template that maps all Terraform attributes to ansible-output host_vars prefixed by 'tf_' as well as setting 'ansible-output_host' to the IP address)", default=get_template_default('TF_ANSIBLE_OUTPUT_HOST_VARS_TEMPLATE', default=DEFAULT_ANSIBLE_OUTPUT_HOST_VARS_TEMPLATE), type=LazyTemplate)
+    parser.add_argument('--ansible-output-groups-template', help="A jinja2 template used to generate a newline separated list (with optional whitespace before or after the newline, which will be stripped) of ansible-output `group` names to which the output record should belong. (default: environment variable TF_ANSIBLE_OUTPUT_GROUPS_TEMPLATE or `%s`])" % (DEFAULT_ANSIBLE_OUTPUT_GROUPS_TEMPLATE), default=get_template_default('TF_ANSIBLE_OUTPUT_GROUPS_TEMPLATE', default=DEFAULT_ANSIBLE_OUTPUT_GROUPS_TEMPLATE), type=LazyTemplate)
+    parser.add_argument('--ansible-output-filter-template', help="A jinja2 template used to filter terraform outputs. This template is rendered for each output and should evaluate to either the string 'True' to include the  or 'False' to exclude it from the output.", default=get_template_default('TF_ANSIBLE_OUTPUT_FILTER_TEMPLATE', default=DEFAULT_ANSIBLE_OUTPUT_FILTER_TEMPLATE), type=LazyTemplate)
+    parser.add_argument('--ansible-host-vars-format', help="Format of the text rendered by the host_vars template: 'text' for newline separated '<key>=<value>' pairs, or 'json' for a single JSON object whose members are used as the host_vars as they are. With 'json', the default host_vars template passes the expanded terraform attributes through untouched. (default: environment variable TF_ANSIBLE_HOST_VARS_FORMAT or 'text')", choices=HOST_VARS_FORMATS, default=os.getenv('TF_ANSIBLE_HOST_VARS_FORMAT', 'text'), dest='host_vars_format')
+    parser.add_argument('--ansible-output-host-vars-format', help="As --ansible-host-vars-format, but for the output host_vars template. (default: environment variable TF_ANSIBLE_OUTPUT_HOST_VARS_FORMAT or 'text')", choices=HOST_VARS_FORMATS, default=os.getenv('TF_ANSIBLE_OUTPUT_HOST_VARS_FORMAT', 'text'), dest='output_host_vars_format')
+    parser.add_argument('--ansible-workers', help="Number of worker processes used to render templates in parallel, or 0 for one per CPU. (default: environment variable TF_ANSIBLE_WORKERS or 1, which renders serially in-process)", type=int, default=int(os.getenv('TF_ANSIBLE_WORKERS', 1)), dest='workers')
+    parser.add_argument('--ansible-cache-dir', help="Directory in which processed inventory is cached between invocations. (default: environment variable TF_ANSIBLE_CACHE_DIR or `%s`)" % (DEFAULT_CACHE_DIR), default=os.getenv('TF_ANSIBLE_CACHE_DIR', DEFAULT_CACHE_DIR), dest='cache_dir')
+    parser.add_argument('--ansible-cache-ttl', help="Maximum age in seconds of a cached inventory before it is regenerated. (default: environment variable TF_ANSIBLE_CACHE_TTL or %d)" % (DEFAULT_CACHE_TTL), type=int, default=int(os.getenv('TF_ANSIBLE_CACHE_TTL', DEFAULT_CACHE_TTL)), dest='cache_ttl')
+    parser.add_argument('--ansible-no-cache', help="Neither read nor write the inventory cache. (default: environment variable TF_ANSIBLE_NO_CACHE or False)", action='store_true', default=get_flag_default('TF_ANSIBLE_NO_CACHE'), dest='no_cache')
+    parser.add_argument('--ansible-invalidate-cache', help="Discard any cached inventory for the current state and templates and regenerate it.", action='store_true', default=False, dest='invalidate_cache')
+    parser.add_argument('--ansible-incremental', help="Memoize the rendered result of each resource and output in the cache directory, and only render those which have changed since the previous run. (default: environment variable TF_ANSIBLE_INCREMENTAL or False)", action='store_true', default=get_flag_default('TF_ANSIBLE_INCREMENTAL'), dest='incremental')
+    parser.add_argument('--ansible-combined', help="Render the filter, inventory name, groups and host_vars templates of each resource (and of each output) in a single pass through one combined template generated from them. (default: environment variable TF_ANSIBLE_COMBINED or False)", action='store_true', default=get_flag_default('TF_ANSIBLE_COMBINED'), dest='combined')
+    parser.add_argument('--ansible-combined-template', help="A jinja2 template used instead of the separate filter, inventory name, groups and host_vars templates, which is rendered once for each terraform resource and calls `_yatadis.set_name(<inventory name>)`, `_yatadis.add_group(<group>)` and `_yatadis.set_host_var(<key>, <value>)`. Resources for which it does not set a name are excluded. (default: environment variable TF_ANSIBLE_COMBINED_TEMPLATE)", default=get_template_default('TF_ANSIBLE_COMBINED_TEMPLATE', default=None), type=LazyTemplate)
+    parser.add_argument('--ansible-output-combined-template', help="As --ansible-combined-template, but for terraform outputs. (default: environment variable TF_ANSIBLE_OUTPUT_COMBINED_TEMPLATE)", default=get_template_default('TF_ANSIBLE_OUTPUT_COMBINED_TEMPLATE', default=None), type=LazyTemplate)
+    parser.add_argument('--ansible-exclude-host-vars', help="A comma separated list of glob patterns of host var names (e.g. 'tf_metadata*,tf_tags*') to leave out of the output. (default: environment variable TF_ANSIBLE_EXCLUDE_HOST_VARS)", default=os.getenv('TF_ANSIBLE_EXCLUDE_HOST_VARS', None), dest='exclude_host_vars')
+    parser.add_argument('--ansible-compact', help="Leave empty host vars (null, \"\", [] and {}) out of the output, and output host vars which have the same value on every host of a group as vars of that group in the --list JSON. (default: environment variable TF_ANSIBLE_COMPACT or False)", action='store_true', default=get_flag_default('TF_ANSIBLE_COMPACT'), dest='compact')
+    parser.add_argument('--ansible-force-jinja', help="Render the built-in default templates through Jinja rather than their equivalent native implementations. (default: environment variable TF_ANSIBLE_FORCE_JINJA or False)", action='store_true', default=get_flag_default('TF_ANSIBLE_FORCE_JINJA'), dest='force_jinja')
+    parser.add_argument('--ansible-daemon-socket', help="Unix socket on which `serve` listens and which is queried for --list/--host before processing the state in-process. (default: environment variable TF_ANSIBLE_DAEMON_SOCKET or a socket in the cache directory named after the state path)", default=os.getenv('TF_ANSIBLE_DAEMON_SOCKET', None), dest='daemon_socket')
+    parser.add_argument('--ansible-daemon-poll-interval', help="Interval in seconds at which `serve` checks the state file for changes. (default: environment variable TF_ANSIBLE_DAEMON_POLL_INTERVAL or %s)" % (DEFAULT_DAEMON_POLL_INTERVAL), type=float, default=float(os.getenv('TF_ANSIBLE_DAEMON_POLL_INTERVAL', DEFAULT_DAEMON_POLL_INTERVAL)), dest='daemon_poll_interval')
+    parser.add_argument('--ansible-no-daemon', help="Do not query a running inventory daemon. (default: environment variable TF_ANSIBLE_NO_DAEMON or False)", action='store_true', default=get_flag_default('TF_ANSIBLE_NO_DAEMON'), dest='no_daemon')
+    return parser
 
-    args.debug and print("Parsing JSON from %s" % (args.terraform_state), file=sys.stderr)
-    tf_state = json.load(args.terraform_state)
-    ansible_data = {}
-    args.debug and print("Processing tf_state data", file=sys.stderr)
-    tf_state_data = process_tfstate(args, tf_state)
-    if args.list:
-        ansible_data = list_groups(tf_state_data)
-    elif args.host is not None:
-        ansible_data = get_host(tf_state_data, args.host)
-    else:
+def run(args):
+    if args.command == 'serve':
+        prepare_templates(args)
+        serve(args)
+        return
+    if not args.list and args.host is None:
         sys.exit("nothing to do (please specify either '--list' or '--host <INVENTORY_NAME>')")
+
+    timings = _timings
+    if not args.no_daemon:
+        ansible_json = query_daemon(args)
+        if ansible_json is not None:
+            timings and timings.count('daemon_answers')
+            timings and timings.start()
+            print(ansible_json)
+            timings and timings.stop('output')
+            return
+
+    # the templates are only compiled once the daemon has not answered
+    prepare_templates(args)
+    builder = InventoryBuilder(args=args)
+    if args.list:
+        builder.inventory()
+        timings and timings.start()
+        builder.write_list(sys.stdout)
+        timings and timings.stop('output')
+        return
+    ansible_data = builder.host(args.host)
+    timings and timings.start()
     print(json.dumps(ansible_data))
+    timings and timings.stop('output')
+
+def report_timings(args, timings):
+    if args.timings_file is None:
+        timings.report(sys.stderr)
+        return
+    with open(args.timings_file, 'w') as f:
+        json.dump(timings.as_dict(), f, indent=2, sort_keys=True)
+        f.write("\n")
 
 
 # A python implementation of the flatmap.Expand function in terraform:
 # https://github.com/hashicorp/terraform/blob/master/flatmap/expand.go
+#
+# Rather than rescanning every key of the flatmap with `startswith` at each
+# level of the expansion (which is quadratic in the number of attributes), the
+# flatmap keys are split on '.' once into a trie of nodes, and the expansion
+# then walks that trie. Each node is a two-element list of
+# [value, children] where value is _FLATMAP_NO_VALUE unless a flatmap key ends
+# at that node and children maps each next key component to its child node.
+_FLATMAP_NO_VALUE = object()
+
+def flatmap_trie(flatmap):
+    root = [_FLATMAP_NO_VALUE, {}]
+    for key, value in flatmap.items():
+        node = root
+        for part in key.split('.'):
+            children = node[1]
+            child = children.get(part)
+            if child is None:
+                child = [_FLATMAP_NO_VALUE, {}]
+                children[part] = child
+            node = child
+        node[0] = value
+    return root
+
 def flatmap_expand(flatmap, key):
-    if key in flatmap.keys():
-        v = flatmap[key]
+    node = flatmap_trie(flatmap)
+    for part in key.split('.'):
+        node = node[1].get(part)
+        if node is None:
+            return None
+    return flatmap_expand_node(node)
+
+def flatmap_expand_node(node):
+    (v, children) = node
+    if v is not _FLATMAP_NO_VALUE:
         if v == "true":
             return True
         elif v == "false":
             return False
         return v
 
-    if key+'.#' in flatmap.keys():
-        return flatmap_expand_array(flatmap, key)
+    count = children.get('#')
+    if count is not None and count[0] is not _FLATMAP_NO_VALUE:
+        return flatmap_expand_array_node(node)
 
-    prefix = key+'.'
-    for k in flatmap.keys():
-        if k.startswith(prefix):
-            return flatmap_expand_dict(flatmap, prefix)
+    if children:
+        return flatmap_expand_dict_node(node)
 
     return None
 
-def flatmap_expand_array(flatmap, prefix):
-    num = int(flatmap[prefix+'.#'])
+def flatmap_expand_array_node(node):
+    children = node[1]
+    # validate the count, although the indexes present decide the length
+    int(children['#'][0])
     key_set = set()
-    for k in flatmap.keys():
-        if not k.startswith(prefix+'.'):
-            continue
-
-        key = k[len(prefix)+1:]
-        idx = key.find('.')
-        if idx != -1:
-            key = key[:idx]
-
+    for key in children.keys():
         if key == '#':
             continue
-
-        k = int(key)
-        key_set.add(k)
-
-    keys_list = []
-    for key in key_set:
-        keys_list.append(key)
-
-    keys_list.sort()
+        key_set.add(int(key))
 
     result = []
-    for key in keys_list:
-        pk = "%s.%d" % (prefix, key)
-        result.append(flatmap_expand(flatmap, pk))
+    for key in sorted(key_set):
+        child = children.get("%d" % (key))
+        if child is None:
+            result.append(None)
+        else:
+            result.append(flatmap_expand_node(child))
 
     return result
 
-def flatmap_expand_dict(flatmap, prefix):
+def flatmap_expand_dict_node(node):
     result = {}
-    for k in flatmap.keys():
-        if not k.startswith(prefix):
-            continue
-
-        key = k[len(prefix):]
-        idx = key.find(".")
-        if idx != -1:
-            key = key[:idx]
-        if key in result:
-            continue
-
+    for key, child in node[1].items():
         if key == '%':
             continue
-
-        result[key] = flatmap_expand(flatmap, k[:len(prefix)+len(key)])
+        result[key] = flatmap_expand_node(child)
 
     return result
 
@@ -382,10 +1889,491 @@ class Resource(dict):
         self._expand_primary_attributes()
 
     def _expand_primary_attributes(self):
-        attributes = self['primary']['attributes']
-        self['primary']['expanded_attributes'] = {}
-        for prefix in set([attr.split('.')[0] for attr in attributes.keys()]):
-            self['primary']['expanded_attributes'][prefix] = flatmap_expand(attributes, prefix)
+        self['primary']['expanded_attributes'] = ExpandedAttributes(self['primary']['attributes'])
+
+class ExpandedAttributes(collections.abc.Mapping):
+    # A read-only mapping of each top-level prefix of a flatmap to its
+    # expanded value. Nothing is expanded until it is accessed: the trie of
+    # flatmap keys is built on first access, and each prefix is expanded and
+    # memoized the first time it is looked up, so items rejected by the filter
+    # template (or templates which only look at a few prefixes) do not pay for
+    # expanding every attribute.
+    def __init__(self, flatmap):
+        self._flatmap = flatmap
+        self._trie_children = None
+        self._expanded = {}
+
+    def _children(self):
+        if self._trie_children is None:
+            timings = _timings
+            timings and timings.start()
+            self._trie_children = flatmap_trie(self._flatmap)[1]
+            timings and timings.stop('expand')
+        return self._trie_children
+
+    def __getitem__(self, prefix):
+        try:
+            return self._expanded[prefix]
+        except KeyError:
+            pass
+        node = self._children()[prefix]
+        timings = _timings
+        timings and timings.start()
+        value = flatmap_expand_node(node)
+        timings and timings.stop('expand')
+        self._expanded[prefix] = value
+        return value
+
+    def __contains__(self, prefix):
+        return prefix in self._children()
+
+    def __iter__(self):
+        return iter(self._children())
+
+    def __len__(self):
+        return len(self._children())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+class Output(dict):
+    def __init__(self, output_name, output_dict):
+        super().__init__(output_dict)
+        self['name'] = output_name
+
+###############################################################################
+# Template compilation:
+# templates are held as LazyTemplates, which keep just the template source
+# until they are first rendered through Jinja, so templates which are
+# replaced by native implementations are never compiled (and if no template
+# is rendered through Jinja, jinja2 is never imported). prepare_templates
+# compiles the remaining ones up front, so that syntax errors are reported
+# before any state is processed. Unless the inventory cache is disabled, the
+# compiled code of each template is kept in the cache directory as Jinja
+# bytecode, keyed by the template source, TEMPLATE_KWARGS and the jinja2
+# version, and is loaded from there rather than compiled again.
+###############################################################################
+TEMPLATE_BYTECODE_CACHE_PATTERN = 'template-%s.cache'
+
+_template_environment = None
+_template_bytecode_cache_dir = None
+_template_bytecode_cache = None
+
+class LazyTemplate(object):
+    def __init__(self, source):
+        self._source = source
+        self._template = None
+
+    def source(self):
+        return self._source
+
+    def compile(self):
+        if self._template is None:
+            self._template = compile_template(self._source)
+        return self._template
+
+    def render(self, *args, **kwargs):
+        return self.compile().render(*args, **kwargs)
+
+def get_template_environment():
+    # the environment shared by all templates
+    global _template_environment, jinja_exc
+    if _template_environment is None:
+        from jinja2 import exceptions
+        from jinjath import TemplateWithSource, set_template_kwargs
+        jinja_exc = exceptions
+        set_template_kwargs(TEMPLATE_KWARGS)
+        environment = TemplateWithSource('').environment
+        # lets the `tojson` filter serialize `primary.expanded_attributes`,
+        # which is a lazy mapping rather than a dict
+        environment.policies['json.dumps_kwargs'] = dict(environment.policies['json.dumps_kwargs'], default=json_default)
+        _template_environment = environment
+    return _template_environment
+
+def use_template_bytecode_cache(args):
+    global _template_bytecode_cache_dir, _template_bytecode_cache
+    _template_bytecode_cache_dir = None if args.no_cache else args.cache_dir
+    _template_bytecode_cache = None
+
+def get_template_bytecode_cache():
+    global _template_bytecode_cache
+    if _template_bytecode_cache is None and _template_bytecode_cache_dir is not None:
+        from jinja2 import FileSystemBytecodeCache
+        _template_bytecode_cache = FileSystemBytecodeCache(_template_bytecode_cache_dir, TEMPLATE_BYTECODE_CACHE_PATTERN)
+    return _template_bytecode_cache
+
+def get_template_cache_name(source):
+    import jinja2
+    return hashlib.sha256(json.dumps([jinja2.__version__, TEMPLATE_KWARGS, source], sort_keys=True).encode()).hexdigest()
+
+def compile_template(source):
+    from jinjath import TemplateWithSource
+    from jinjath.jinjath import TemplateWithSourceSyntaxError
+    environment = get_template_environment()
+    bytecode_cache = get_template_bytecode_cache()
+    bucket = None
+    code = None
+    if bytecode_cache is not None:
+        bucket = bytecode_cache.get_bucket(environment, get_template_cache_name(source), None, source)
+        code = bucket.code
+        if code is not None:
+            # bytecode which is in use is kept from being pruned
+            with contextlib.suppress(OSError):
+                os.utime(os.path.join(_template_bytecode_cache_dir, TEMPLATE_BYTECODE_CACHE_PATTERN % (bucket.key)))
+    if code is None:
+        try:
+            code = environment.compile(source)
+        except jinja_exc.TemplateSyntaxError as e:
+            raise TemplateWithSourceSyntaxError("Syntax error in template. Template source was '%s'" % (source)) from e
+        if bucket is not None:
+            bucket.code = code
+            try:
+                os.makedirs(_template_bytecode_cache_dir, mode=0o700, exist_ok=True)
+                bytecode_cache.set_bucket(bucket)
+            except OSError as e:
+                print("WARNING: could not write template bytecode cache in %s: %s" % (_template_bytecode_cache_dir, e), file=sys.stderr)
+    template = TemplateWithSource.from_code(environment, code, environment.make_globals(None))
+    template._source = source
+    return template
+
+def compile_templates(args):
+    lazy_templates = []
+    for template_arg in TEMPLATE_ARGS + COMBINED_TEMPLATE_ARGS:
+        template = getattr(args, template_arg)
+        if isinstance(template, JsonHostVarsTemplate):
+            template = template.template
+        if isinstance(template, LazyTemplate):
+            lazy_templates.append((template_arg, template))
+    if len(lazy_templates) == 0:
+        return
+    from jinjath.jinjath import TemplateWithSourceSyntaxError
+    for (template_arg, template) in lazy_templates:
+        try:
+            template.compile()
+        except TemplateWithSourceSyntaxError as e:
+            raise TemplateWithSourceSyntaxError("Syntax error in template specified by --%s." % (template_arg.replace('_', '-'))) from e
+
+###############################################################################
+# Native templates:
+# the built-in default templates are replaced by equivalent python code which
+# produces exactly the same result as rendering them through Jinja, but
+# without building a Jinja context or re-parsing the rendered text. Any other
+# template source (or all of them, with `--ansible-force-jinja`) is rendered
+# through Jinja as usual.
+###############################################################################
+class NativeTemplate(object):
+    def __init__(self, source):
+        self._source = source
+        self._jinja_template = None
+
+    def source(self):
+        return self._source
+
+    def jinja_template(self):
+        if self._jinja_template is None:
+            self._jinja_template = compile_template(self._source)
+        return self._jinja_template
+
+    def render(self, item):
+        return self.jinja_template().render(item)
+
+class NativeConstantTemplate(NativeTemplate):
+    def render(self, item):
+        return self._source
+
+class NativeNameTemplate(NativeTemplate):
+    def render(self, item):
+        return str(item['name'])
+
+class NativeResourceTypeFilterTemplate(NativeTemplate):
+    def __init__(self, source, types):
+        super().__init__(source)
+        self._types = types
+
+    def render(self, item):
+        try:
+            return str(item.get('type') in self._types)
+        except TypeError:
+            return self.jinja_template().render(item)
+
+class NativeDefaultHostVarsTemplate(NativeTemplate):
+    def __init__(self, source, host_attributes):
+        super().__init__(source)
+        self._host_attributes = host_attributes
+
+    def render_host_vars(self, item):
+        # returns the (key, value) host vars that rendering the template and
+        # parsing the result would produce, or None if a value is one which
+        # would be mangled by the newline-separated text format, in which
+        # case the caller falls back to rendering through Jinja
+        primary = item['primary']
+        attributes = primary['attributes']
+        ansible_host = ''
+        for attr in self._host_attributes:
+            ansible_host = attributes.get(attr, '')
+            if ansible_host:
+                break
+        ansible_host = str(ansible_host)
+        if '\n' in ansible_host:
+            return None
+        try:
+            return self.render_host_var_items(ansible_host, primary['expanded_attributes'])
+        except (ValueError, SyntaxError):
+            # a value which does not parse; rendering through Jinja reports it
+            return None
+
+    def render_host_var_items(self, ansible_host, expanded_attributes):
+        host_var_items = [('ansible_host', parse_host_var_value(ansible_host))]
+        for (attr, value) in expanded_attributes.items():
+            key = ('tf_%s' % (attr)).strip()
+            if '=' in attr or '\n' in attr:
+                return None
+            if isinstance(value, (list, dict)):
+                # the text form of a list or dict is its repr, which
+                # literal_eval turns straight back into an equal value
+                host_var_items.append((key, value))
+                continue
+            value = str(value)
+            if '\n' in value:
+                return None
+            host_var_items.append((key, parse_host_var_value(value)))
+        return host_var_items
+
+class NativeDefaultJsonHostVarsTemplate(NativeTemplate):
+    def __init__(self, source, host_attributes):
+        super().__init__(source)
+        self._host_attributes = host_attributes
+
+    def render_host_vars(self, item):
+        # returns the (key, value) host vars that rendering the template and
+        # parsing the resulting JSON would produce, i.e. the expanded
+        # attributes untouched other than the order of map keys, which
+        # Jinja's `tojson` sorts
+        primary = item['primary']
+        attributes = primary['attributes']
+        ansible_host = ''
+        for attr in self._host_attributes:
+            ansible_host = attributes.get(attr, '')
+            if ansible_host:
+                break
+        host_var_items = [('ansible_host', ansible_host)]
+        for (attr, value) in primary['expanded_attributes'].items():
+            if isinstance(value, (list, dict)):
+                value = sort_json_keys(value)
+            host_var_items.append(('tf_%s' % (attr), value))
+        return host_var_items
+
+def sort_json_keys(value):
+    if isinstance(value, dict):
+        return {key: sort_json_keys(value[key]) for key in sorted(value)}
+    elif isinstance(value, list):
+        return [sort_json_keys(element) for element in value]
+    return value
+
+class NativeEmptyHostVarsTemplate(NativeTemplate):
+    def render_host_vars(self, item):
+        return []
+
+def get_native_template(source, host_vars_format=None):
+    # host_vars_format is the format of a host vars template, or None for any
+    # other template: the native host vars templates are only used for host
+    # vars templates, and the others only for templates which are not
+    if host_vars_format is None:
+        if source in (DEFAULT_ANSIBLE_INVENTORY_NAME_TEMPLATE, DEFAULT_ANSIBLE_OUTPUT_INVENTORY_NAME_TEMPLATE):
+            return NativeNameTemplate(source)
+        elif source in (DEFAULT_ANSIBLE_GROUPS_TEMPLATE, DEFAULT_ANSIBLE_OUTPUT_GROUPS_TEMPLATE, DEFAULT_ANSIBLE_OUTPUT_FILTER_TEMPLATE):
+            return NativeConstantTemplate(source)
+        elif source == DEFAULT_ANSIBLE_RESOURCE_FILTER_TEMPLATE:
+            return NativeResourceTypeFilterTemplate(source, DEFAULT_ANSIBLE_RESOURCE_TYPES)
+        return None
+    if source == DEFAULT_ANSIBLE_OUTPUT_HOST_VARS_TEMPLATE:
+        return NativeEmptyHostVarsTemplate(source)
+    elif host_vars_format == 'json' and source == DEFAULT_ANSIBLE_HOST_VARS_JSON_TEMPLATE:
+        return NativeDefaultJsonHostVarsTemplate(source, DEFAULT_ANSIBLE_HOST_ATTRIBUTES)
+    elif host_vars_format != 'json' and source == DEFAULT_ANSIBLE_HOST_VARS_TEMPLATE:
+        return NativeDefaultHostVarsTemplate(source, DEFAULT_ANSIBLE_HOST_ATTRIBUTES)
+    return None
+
+def use_native_templates(args):
+    for template_arg in TEMPLATE_ARGS:
+        host_vars_format = template_arg in HOST_VARS_FORMAT_ARGS and getattr(args, HOST_VARS_FORMAT_ARGS[template_arg]) or None
+        native_template = get_native_template(getattr(args, template_arg).source(), host_vars_format)
+        if native_template is not None:
+            args.debug and print("Using native implementation of %s" % (template_arg), file=sys.stderr)
+            setattr(args, template_arg, native_template)
+
+###############################################################################
+# JSON host vars:
+# with a host vars format of 'json' (`--ansible-host-vars-format json`), the
+# host vars template renders a single JSON object rather than newline
+# separated '<key>=<value>' pairs, and its members are used as the host_vars
+# as they are. The default host vars template is then replaced by
+# DEFAULT_ANSIBLE_HOST_VARS_JSON_TEMPLATE (or rather, by its native
+# implementation), which passes the expanded attributes through untouched.
+###############################################################################
+class JsonHostVarsTemplate(object):
+    def __init__(self, template):
+        self.template = template
+
+    def source(self):
+        return self.template.source()
+
+    def render(self, item):
+        return self.template.render(item)
+
+def json_default(value):
+    if isinstance(value, collections.abc.Mapping):
+        return dict(value.items())
+    raise TypeError("Object of type %s is not JSON serializable" % (type(value).__name__))
+
+def use_json_host_vars_templates(args):
+    for (template_arg, format_arg) in HOST_VARS_FORMAT_ARGS.items():
+        host_vars_format = getattr(args, format_arg)
+        if host_vars_format not in HOST_VARS_FORMATS:
+            sys.exit("Unknown %s '%s' (must be one of %s)" % (format_arg, host_vars_format, ", ".join(HOST_VARS_FORMATS)))
+        if host_vars_format != 'json':
+            continue
+        template = getattr(args, template_arg)
+        if template.source() == DEFAULT_ANSIBLE_HOST_VARS_TEMPLATE:
+            template = LazyTemplate(DEFAULT_ANSIBLE_HOST_VARS_JSON_TEMPLATE)
+        setattr(args, template_arg, JsonHostVarsTemplate(template))
+
+###############################################################################
+# Combined templates:
+# rather than rendering the filter, inventory name, groups and host vars
+# templates separately (building a Jinja context from the item four times),
+# they can be rendered in a single pass by one combined template per item
+# type, which writes its results into a CombinedResult passed to it as
+# `_yatadis`. With `--ansible-combined`, a combined template is generated
+# automatically from the (non-native) separate templates, with each one's
+# output captured in a `{% set %}` block so that it is exactly what rendering
+# it separately would produce. Alternatively, a combined template can be
+# written directly, calling `_yatadis.set_name()`, `_yatadis.add_group()` and
+# `_yatadis.set_host_var()`; items for which it does not set a name are
+# excluded.
+###############################################################################
+COMBINED_TEMPLATE_ARGS = (
+    'ansible_combined_template',
+    'ansible_output_combined_template',
+)
+
+# each source starts at the beginning of a line (the newline after the
+# `{% set %}` tag being removed by trim_blocks), so that lstrip_blocks
+# applies to its first line as it does when it is rendered on its own, and
+# ends with an empty expression, so that lstrip_blocks does not strip
+# trailing whitespace before the `{% endset %}` tag
+COMBINED_TEMPLATE_PART = '{%% set _yatadis_%(part)s %%}\n%(source)s{{ "" }}{%% endset %%}{{ _yatadis.set_%(part)s_text(_yatadis_%(part)s) }}'
+
+class CombinedResult(object):
+    def __init__(self):
+        self.filter_value = None
+        self.accepted = True
+        self.inventory_name = None
+        self.group_names = None
+        self.host_vars_text = None
+        self.host_var_items = None
+
+    # set by generated combined templates
+    def set_filter_text(self, text):
+        self.filter_value = text
+        self.accepted = (text == "True")
+        return ''
+
+    def set_inventory_name_text(self, text):
+        self.inventory_name = text
+        return ''
+
+    def set_groups_text(self, text):
+        self.group_names = re.split(r'\s*\n\s*', text)
+        return ''
+
+    def set_host_vars_text(self, text):
+        self.host_vars_text = text
+        return ''
+
+    # set by user-written combined templates
+    def set_name(self, inventory_name):
+        self.inventory_name = str(inventory_name)
+        return ''
+
+    def add_group(self, group_name):
+        if self.group_names is None:
+            self.group_names = []
+        self.group_names.append(str(group_name))
+        return ''
+
+    def set_host_var(self, key, value):
+        # values are output as JSON, so mappings such as
+        # `primary.expanded_attributes` are converted to dicts (as for
+        # `tojson`), and any other value which cannot be is rejected here
+        # rather than part way through writing the output
+        try:
+            json.dumps(value)
+        except TypeError:
+            try:
+                value = json.loads(json.dumps(value, default=json_default))
+            except TypeError as e:
+                raise ValueError("host_var '%s' cannot be output as JSON: %s" % (key, e))
+        if self.host_var_items is None:
+            self.host_var_items = []
+        self.host_var_items.append((str(key), value))
+        return ''
+
+class CombinedTemplate(object):
+    def __init__(self, template, generated_parts=None):
+        self.template = template
+        # None for a user-written combined template, otherwise the parts
+        # ('filter', 'inventory_name', 'groups', 'host_vars') it renders
+        self.generated_parts = generated_parts
+
+    def source(self):
+        return self.template.source()
+
+    def render_result(self, item):
+        result = CombinedResult()
+        self.template.render(item, _yatadis=result)
+        return result
+
+def generate_combined_template(filter_template, inventory_name_template, groups_template, host_vars_template):
+    parts = [(part, template) for (part, template) in (('filter', filter_template), ('inventory_name', inventory_name_template), ('groups', groups_template), ('host_vars', host_vars_template)) if not isinstance(template, NativeTemplate)]
+    if not parts:
+        return None
+    pieces = []
+    for (part, template) in parts:
+        # a template rendered on its own loses a single trailing newline
+        source = re.sub(r'(\r\n|\r|\n)\Z', '', template.source(), count=1)
+        pieces.append(COMBINED_TEMPLATE_PART % {'part': part, 'source': source})
+        if part == 'filter':
+            pieces.append('{% if _yatadis.accepted %}')
+    if parts[0][0] == 'filter':
+        pieces.append('{% endif %}')
+    from jinjath.jinjath import TemplateWithSourceSyntaxError
+    try:
+        template = compile_template(''.join(pieces))
+    except TemplateWithSourceSyntaxError:
+        # e.g. a template with unbalanced block tags which only work on
+        # their own; render the templates separately
+        return None
+    return CombinedTemplate(template, generated_parts=frozenset(part for (part, _) in parts))
+
+def get_combined_template(combined_template, combined_p, filter_template, inventory_name_template, groups_template, host_vars_template):
+    if combined_template is not None:
+        return CombinedTemplate(combined_template)
+    if combined_p:
+        return generate_combined_template(filter_template, inventory_name_template, groups_template, host_vars_template)
+    return None
+
+def prepare_templates(args):
+    get_templates_key(args)
+    use_template_bytecode_cache(args)
+    use_json_host_vars_templates(args)
+    if not args.force_jinja:
+        use_native_templates(args)
+    compile_templates(args)
+    args.resource_combined_template = get_combined_template(args.ansible_combined_template, args.combined, args.ansible_resource_filter_template, args.ansible_inventory_name_template, args.ansible_groups_template, args.ansible_host_vars_template)
+    args.output_combined_template = get_combined_template(args.ansible_output_combined_template, args.combined, args.ansible_output_filter_template, args.ansible_output_inventory_name_template, args.ansible_output_groups_template, args.ansible_output_host_vars_template)
+    args.debug and args.resource_combined_template is not None and print("Using combined resource template '%s'" % (args.resource_combined_template.source()), file=sys.stderr)
+    args.debug and args.output_combined_template is not None and print("Using combined output template '%s'" % (args.output_combined_template.source()), file=sys.stderr)
 
 def get_template_default(*env_vars, default=''):
     template_source = None
@@ -396,7 +2384,16 @@ def get_template_default(*env_vars, default=''):
             break
     if template_source is None:
         template_source = default
-    return TemplateWithSource(template_source)
+    if template_source is None:
+        return None
+    return LazyTemplate(template_source)
+
+def get_flag_default(*env_vars, default=False):
+    for var in env_vars:
+        value = os.getenv(var, None)
+        if value is not None:
+            return value.strip().lower() not in ('', '0', 'false', 'no', 'off')
+    return default
 
 if __name__ == '__main__':
     main()